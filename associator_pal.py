@@ -1,43 +1,12 @@
+import os, heapq
 import numpy as np
+from data_pipeline import sec_to_utc, hash_key, atomic_save
 
-class TS_Assoc(object):
-
-  """ Associate picks by searching ot (time, T) and loc (space, S) clustering
-  Inputs
-    sta_dict: station location dict
-    xy_margin: ratio of lateral (x-y) margin relative to the station range
-    xy_grid: grid width for x-y axis (in degree)
-    z_grids: grids for z axis (in km)
-    ot_dev: max time dev for ot assoc
-    max_res: threshold for P travel time res
-    min_sta: min number of station to alert a detection
-    *note: lateral distance (x-y) in degree; depth in km; elevation in m
-  Usage
-    import associator_pal
-    associator = associator_pal.TS_Assoc(sta_dict)
-    associator.associate(picks, out_ctlg, out_pha)
+class TS_Assoc_Base(object):
+  """ Base of associators: temporal assoc, magnitude & output
+    subclass provides the spatial assoc (assoc_loc, get_max_tt) and attributes:
+    ot_dev & min_sta (params), sta_list & sta_loc (sta idx of picks --> net_sta & [lat, lon, ele])
   """
-  
-  def __init__(self,
-               sta_dict,
-               xy_margin = 0.2,
-               xy_grid   = 0.02,
-               z_grids   = [5],
-               vp        = 5.9,
-               ot_dev    = 2.5,
-               max_res   = 1.5,
-               min_sta   = 4):
-
-    self.sta_dict  = sta_dict
-    self.xy_margin = xy_margin
-    self.xy_grid   = xy_grid
-    self.z_grids   = z_grids
-    self.vp        = vp
-    self.ot_dev    = ot_dev
-    self.max_res   = max_res
-    self.min_sta   = min_sta
-    self.tt_dict   = self.calc_tt()
-
 
   def associate(self, picks, out_ctlg=None, out_pha=None):
     # 1. temporal assoc: picks --> event_picks
@@ -67,127 +36,71 @@ class TS_Assoc(object):
     if not out_ctlg or not out_pha: return events, picks
 
 
+  # associate one time shard: picks with sta_ot in [t0-halo, t1+halo) --> events with ot in [t0, t1)
+  #   t0, t1 & halo in epoch sec (t0=-inf / t1=inf for open outer shards); shards sharing halos keep each event once
+  def associate_shard(self, picks, t0, t1, halo):
+    in_shard = (picks['sta_ot'] >= t0 - halo) & (picks['sta_ot'] < t1 + halo)
+    events, event_picks = self.associate(picks[in_shard])
+    t0 = sec_to_utc(t0) if np.isfinite(t0) else None
+    t1 = sec_to_utc(t1) if np.isfinite(t1) else None
+    is_own = [(t0 is None or t0 <= event['evt_ot']) and (t1 is None or event['evt_ot'] < t1) for event in events]
+    return [event for event, own in zip(events, is_own) if own], \
+           [event_pick for event_pick, own in zip(event_picks, is_own) if own]
+
+
   # 1. temporal assoc by ot clustering: picks --> event_picks
+  # ot in int ns, sorted: neighbors in a win are an index range (searchsorted)
   def assoc_ot(self, picks):
     event_picks = []
     num_picks = len(picks)
     if num_picks==0: return []
     picks = np.sort(picks, order='sta_ot')
+    ots = sec_to_us(picks['sta_ot']) * 1000
+    # ot_dev to ns (as UTCDateTime diff, rounded to us)
+    dev_ns  = sec_to_ns(self.ot_dev)               # |dt| < ot_dev
+    dev_ns1 = sec_to_ns(self.ot_dev, strict=True)  # |dt| > ot_dev
+    dev_ns2 = sec_to_ns(2*self.ot_dev)             # |dt| < 2*ot_dev
     # calc num of ot neighbors (num_nbr)
-    num_nbr = np.zeros(num_picks)
-    ots = picks['sta_ot']
-    for i in range(len(ots)):
-        is_nbr = abs(ots-ots[i]) < self.ot_dev
-        num_nbr[i] = sum(is_nbr.astype(float))
+    nbr_idx0 = np.searchsorted(ots, ots - dev_ns, 'right')
+    nbr_idx1 = np.searchsorted(ots, ots + dev_ns, 'left')
+    num_nbr = nbr_idx1 - nbr_idx0
+    # max num_nbr (first idx for ties) by heap, lazy update
+    nbr_heap = list(zip(-num_nbr, range(num_picks)))
+    heapq.heapify(nbr_heap)
     # assoc each cluster
     for _ in range(num_picks):
-        if np.amax(num_nbr) < self.min_sta: break
+        while nbr_heap and -nbr_heap[0][0] != num_nbr[nbr_heap[0][1]]: heapq.heappop(nbr_heap)
+        if not nbr_heap or -nbr_heap[0][0] < self.min_sta: break
         # ot assoc
-        ot_i = ots[np.argmax(num_nbr)]
-        to_assoc = abs(ots-ot_i) < self.ot_dev
-        event_picks.append(picks[to_assoc])
-        num_nbr[to_assoc] = 0
-        # renew num_nbr
-        to_renew = (abs(ots-ot_i)>self.ot_dev)*(abs(ots-ot_i)<2*self.ot_dev)
-        ots_todel = ots[to_assoc]
-        nbr_todel = [sum(abs(ots_todel-ot_j)<self.ot_dev) for ot_j in ots[to_renew]]
-        num_nbr[to_renew] -= nbr_todel
+        i = nbr_heap[0][1]
+        ot_i, idx0, idx1 = ots[i], nbr_idx0[i], nbr_idx1[i]
+        event_picks.append(picks[idx0:idx1])
+        num_nbr[idx0:idx1] = 0
+        # renew num_nbr: remove assoc picks from neighbors
+        to_renew = np.concatenate([
+            np.arange(np.searchsorted(ots, ot_i - dev_ns2, 'right'),
+                      np.searchsorted(ots, ot_i - dev_ns1, 'right')),
+            np.arange(np.searchsorted(ots, ot_i + dev_ns1, 'left'),
+                      np.searchsorted(ots, ot_i + dev_ns2, 'left'))])
+        nbr_todel = np.minimum(nbr_idx1[to_renew], idx1) - np.maximum(nbr_idx0[to_renew], idx0)
+        num_nbr[to_renew] -= np.maximum(nbr_todel, 0)
+        for j in to_renew: heapq.heappush(nbr_heap, (-num_nbr[j], j))
     return event_picks
 
 
-  # 2. spatial assoc by locate event: event_pick --> event_loc
-  def assoc_loc(self, event_pick):
-    res_ttp_mat = 0 # P travel time res
-    num_sta_mat = 0 # number of associated stations
-    det_dict = {} # potential det loc for each sta
-    ot = event_pick['sta_ot'][len(event_pick)//2]
-    bad_idx = []
-    for i, pick in enumerate(event_pick):
-        net_sta = pick['net_sta']
-        ttp_obs = pick['tp'] - ot # pick time to travel time
-        ttp_pred = self.tt_dict[net_sta]
-        res_i = abs(ttp_pred - ttp_obs)
-        is_det = (res_i < self.max_res).astype(float)
-        res_i[res_i >= self.max_res] = 0.
-        # update res_mat, det_dict, and num_sta_mat
-        if np.amax(is_det)==0: bad_idx.append(i); continue
-        if net_sta in det_dict: bad_idx.append(i); continue
-        res_ttp_mat += res_i
-        det_dict[net_sta] = is_det
-        num_sta_mat += is_det
-    event_pick = np.delete(event_pick, bad_idx)
-    # find loc of min res (grid search location)
-    num_sta = np.amax(num_sta_mat)
-    if num_sta < self.min_sta: return [],[]
-    res_ttp_mat /= num_sta
-    res_ttp_mat [num_sta_mat < num_sta] = np.inf
-    res = np.amin(res_ttp_mat)
-    zi, x, y = np.unravel_index(np.argmin(res_ttp_mat), res_ttp_mat.shape)
-    lon = self.lon_range[0] + x * self.xy_grid
-    lat = self.lat_range[0] + y * self.xy_grid
-    dep = self.z_grids[zi]
-    # find associated phase
-    event_pick = [pick for pick in event_pick if det_dict[pick['net_sta']][zi,x,y]==1.]
-    # output
-    event_loc = {'evt_ot' : ot, 
-                 'evt_lon': round(lon,2), 
-                 'evt_lat': round(lat,2),
-                 'evt_dep': round(dep,0),
-                 'res': round(res,1)}
-    return event_loc, event_pick
-
-
-  # calc time table
-  def calc_tt(self):
-    print('making time table')
-    tt_dict = {}
-    # get x-y range: sta range + margin
-    sta_loc = self.sta_dict.values()
-    lat = [sta_loc[0] for sta_loc in self.sta_dict.values()]
-    lon = [sta_loc[1] for sta_loc in self.sta_dict.values()]
-    lon_margin = self.xy_margin * (np.amax(lon) - np.amin(lon))
-    lat_margin = self.xy_margin * (np.amax(lat) - np.amin(lat))
-    lon_range = [np.amin(lon)-lon_margin, np.amax(lon)+lon_margin]
-    lat_range = [np.amin(lat)-lat_margin, np.amax(lat)+lat_margin]
-    cos_lat = np.cos(np.mean(lat_range) * np.pi/180)
-    # set x-y grid
-    x_num = int((lon_range[1]-lon_range[0]) / self.xy_grid)
-    y_num = int((lat_range[1]-lat_range[0]) / self.xy_grid)
-    # calc time table
-    for net_sta, [lat,lon,ele,_] in self.sta_dict.items():
-        # convert to x-y grid_idx
-        sta_x = int((lon-lon_range[0]) / self.xy_grid)
-        sta_y = int((lat-lat_range[0]) / self.xy_grid)
-        # calc P travel time
-        ttp = -np.ones([len(self.z_grids), x_num, y_num])
-        for x in range(x_num):
-          for y in range(y_num):
-            for zi,z in enumerate(self.z_grids):
-                dx = 111 * (x-sta_x) * self.xy_grid * cos_lat # degree to km
-                dy = 111 * (y-sta_y) * self.xy_grid
-                dz = z + ele/1000.
-                ttp[zi,x,y] = np.sqrt(dx**2 + dy**2 + dz**2) / self.vp
-        tt_dict[net_sta] = ttp
-    self.lon_range = lon_range
-    self.lat_range = lat_range
-    return tt_dict
-
-
   # calc mag with picks (s_amp)
   def calc_mag(self, event_pick, event_loc):
     num_sta = len(event_pick)
     mag = -np.ones(num_sta)
-    for i,pick in enumerate(event_pick):
-        sta_lat, sta_lon, sta_ele = self.sta_dict[pick['net_sta']][0:3]
-        # get S amp
-        if 's_amp' not in pick.dtype.names: continue
-        amp = pick['s_amp'] * 1e6 # m to miu m
+    if 's_amp' in event_pick.dtype.names:
+        sta_lat, sta_lon, sta_ele = self.sta_loc[event_pick['sta']].T
+        amp = event_pick['s_amp'].astype(np.float64) * 1e6 # m to miu m
         # calc epi dist
         dist_lat = 111*(sta_lat - event_loc['evt_lat'])
         dist_lon = 111*(sta_lon - event_loc['evt_lon']) * np.cos(sta_lat*np.pi/180)
         dist_dep = event_loc['evt_dep'] + sta_ele/1e3
         dist = np.sqrt(dist_lon**2 + dist_lat**2 + dist_dep**2)
-        mag[i] = np.log10(amp) + np.log10(dist) + 1
+        mag = np.log10(amp) + np.log10(dist) + 1
     # remove one outlier
     mag_dev = abs(mag - np.median(mag))
     mag = np.delete(mag, np.argmax(mag_dev))
@@ -215,10 +128,547 @@ class TS_Assoc(object):
     res = event_loc['res']
     out_pha.write('{},{},{},{},{},{}\n'.format(ot, lat, lon, dep, mag, res))
     for pick in event_pick:
-        net_sta = pick['net_sta']
-        tp = pick['tp']
-        ts = pick['ts']
+        net_sta = self.sta_list[pick['sta']]
+        tp = sec_to_utc(pick['tp'])
+        ts = sec_to_utc(pick['ts'])
         s_amp = pick['s_amp'] if 's_amp' in pick.dtype.names else -1
         p_snr = pick['p_snr'] if 'p_snr' in pick.dtype.names else -1
-        out_pha.write('{},{},{},{},{:.1f}\n'.format(net_sta, tp, ts, s_amp, p_snr))
+        out_pha.write('{},{},{},{},{:.1f}\n'.format(net_sta, tp, ts, str(s_amp), p_snr))
+
+
+class TS_Assoc(TS_Assoc_Base):
+
+  """ Associate picks by searching ot (time, T) and loc (space, S) clustering
+  Inputs
+    sta_dict: station location dict
+    xy_margin: ratio of lateral (x-y) margin relative to the station range
+    xy_grid: grid width for x-y axis (in degree)
+    z_grids: grids for z axis (in km)
+    ot_dev: max time dev for ot assoc
+    max_res: threshold for P travel time res
+    min_sta: min number of station to alert a detection
+    picks: numeric picks (data_pipeline.pick_dtype), sta indexed as in sta_dict
+    tt_dtype: dtype of travel time table (np.float64 or np.float32)
+    tt_cache_dir: dir to cache time table (.npy, memory-mapped); None for no cache
+    coarse_factor: num of xy_grid per coarse cell for coarse-to-fine loc search (1 for exhaustive search)
+    vel_mod: 1-D layered P velocity model (CRE file, as for hypoInverse); None to use const vp
+      (one lookup table for all sta, instead of a time table per sta; tt_cache_dir not used)
+    ref_ele: ref elevation (in km) of vel_mod, i.e. elevation of its zero depth
+    *note: lateral distance (x-y) in degree; depth in km; elevation in m
+  Usage
+    import associator_pal
+    associator = associator_pal.TS_Assoc(sta_dict)
+    associator.associate(picks, out_ctlg, out_pha)
+  """
+  
+  def __init__(self,
+               sta_dict,
+               xy_margin = 0.2,
+               xy_grid   = 0.02,
+               z_grids   = [5],
+               vp        = 5.9,
+               ot_dev    = 2.5,
+               max_res   = 1.5,
+               min_sta   = 4,
+               tt_dtype  = np.float64,
+               tt_cache_dir = None,
+               coarse_factor = 1,
+               vel_mod   = None,
+               ref_ele   = 0.):
+
+    self.sta_dict  = sta_dict
+    self.xy_margin = xy_margin
+    self.xy_grid   = xy_grid
+    self.z_grids   = z_grids
+    self.vp        = vp
+    self.ot_dev    = ot_dev
+    self.max_res   = max_res
+    self.min_sta   = min_sta
+    self.tt_dtype  = np.dtype(tt_dtype).type
+    self.ref_ele   = ref_ele
+    self.v_min     = vp # min velocity, bounds tt change with dist
+    self.tt_table  = None # (n_sta, nz, nx, ny) array; None for 1-D lookup table
+    if vel_mod: self.tt_lookup = self.calc_tt_lookup(*read_vel_mod(vel_mod))
+    else: self.tt_dict = self.load_tt(tt_cache_dir) if tt_cache_dir else self.calc_tt()
+    self.coarse_factor = coarse_factor
+    self.tt_coarse = self.calc_tt_coarse() if coarse_factor>1 else None
+    self.loc_chunk = 32   # max num of picks per vectorized res calc
+    self.loc_buf   = None
+
+
+  # 2. spatial assoc by locate event: event_pick --> event_loc
+  def assoc_loc(self, event_pick):
+    ot = event_pick['sta_ot'][len(event_pick)//2]
+    sta_idx = event_pick['sta'].astype(int)
+    ttp_obs = (sec_to_us(event_pick['tp']) - sec_to_us(ot)) / 1e6 # pick time to travel time
+    ttp_obs = ttp_obs.astype(self.tt_dtype)
+    # find loc of min res (grid search location)
+    if self.tt_coarse: loc = self.search_coarse_fine(sta_idx, ttp_obs)
+    else: loc = self.search_grid(sta_idx, ttp_obs)
+    if loc is None: return [],[]
+    is_good, res, zi, x, y = loc
+    event_pick, sta_idx, ttp_obs = event_pick[is_good], sta_idx[is_good], ttp_obs[is_good]
+    lon = self.lon_range[0] + x * self.xy_grid
+    lat = self.lat_range[0] + y * self.xy_grid
+    dep = self.z_grids[zi]
+    # find associated phase
+    is_det = abs(self.get_tt(sta_idx, zi, x, y) - ttp_obs) < self.max_res
+    event_pick = event_pick[is_det]
+    # output
+    event_loc = {'evt_ot' : sec_to_utc(ot), 
+                 'evt_lon': round(lon,2), 
+                 'evt_lat': round(lat,2),
+                 'evt_dep': round(dep,0),
+                 'res': round(res,1)}
+    return event_loc, event_pick
+
+
+  # exhaustive grid search: res of all picks on the whole grid, in chunks of picks
+  def search_grid(self, sta_idx, ttp_obs):
+    num_picks = len(sta_idx)
+    res_buf, det_buf, res_ttp_mat, num_sta_mat = self.get_loc_buf()
+    chunk = len(res_buf) - 1
+    res_ttp_mat[:] = 0 # P travel time res
+    num_sta_mat[:] = 0 # number of associated stations
+    is_good = np.zeros(num_picks, dtype=bool)
+    det_sta = set()
+    for i0 in range(0, num_picks, chunk):
+        i1 = min(i0+chunk, num_picks)
+        # res & is_det: (n_pick, nz, nx, ny); row 0 of buf is left for the sum
+        res, is_det = res_buf[1:i1-i0+1], det_buf[1:i1-i0+1]
+        if self.tt_table is not None: np.take(self.tt_table, sta_idx[i0:i1], axis=0, out=res)
+        else:
+            for k, sta_idx_k in enumerate(sta_idx[i0:i1]): res[k] = self.get_tt(sta_idx_k, *self.grid_idx)
+        res -= ttp_obs[i0:i1, None, None, None]
+        np.abs(res, out=res)
+        np.less(res, self.max_res, out=is_det)
+        np.multiply(res, is_det, out=res)
+        has_det = is_det.reshape(i1-i0, -1).any(axis=1)
+        good_idx = self.get_good_picks(sta_idx[i0:i1], has_det, det_sta)
+        is_good[i0:i1][good_idx] = True
+        num_good = len(good_idx)
+        for k, good_k in enumerate(good_idx):
+            if k == good_k: continue
+            res[k], is_det[k] = res[good_k], is_det[good_k]
+        # update res_mat & num_sta_mat, adding picks in order
+        res_buf[0], det_buf[0] = res_ttp_mat, num_sta_mat
+        np.sum(res_buf[0:num_good+1], axis=0, out=res_ttp_mat)
+        np.sum(det_buf[0:num_good+1], axis=0, out=num_sta_mat)
+    num_sta = np.amax(num_sta_mat)
+    if num_sta < self.min_sta: return
+    res_ttp_mat /= num_sta
+    res_ttp_mat [num_sta_mat < num_sta] = np.inf
+    res = np.amin(res_ttp_mat)
+    zi, x, y = np.unravel_index(np.argmin(res_ttp_mat), res_ttp_mat.shape)
+    return is_good, res, zi, x, y
+
+
+  # coarse-to-fine grid search: upper bound of num_sta on coarse cells, 
+  #   then refine cells (in order of the bound) until no cell can beat the best loc
+  def search_coarse_fine(self, sta_idx, ttp_obs, max_chunk_size=2**22):
+    tt_coarse, tt_min, tt_max, slack = self.tt_coarse
+    f = self.coarse_factor
+    nz, nx, ny = self.grid_shape
+    # has_det on the fine grid, by tt range of each z layer (no gap >= 2*max_res in a layer)
+    obs = ttp_obs[:,None]
+    t0, t1 = tt_min[sta_idx], tt_max[sta_idx]
+    has_det = ((t0 <= obs) & (obs <= t1)) | (abs(t0 - obs) < self.max_res) | (abs(t1 - obs) < self.max_res)
+    good_idx = self.get_good_picks(sta_idx, has_det.any(axis=1), set())
+    is_good = np.zeros(len(sta_idx), dtype=bool)
+    is_good[good_idx] = True
+    sta_idx, ttp_obs = sta_idx[good_idx], ttp_obs[good_idx]
+    if len(sta_idx) < self.min_sta: return
+    # upper bound of num_sta in each coarse cell: res < max_res + slack at cell center
+    res = abs(tt_coarse[sta_idx] - ttp_obs[:, None, None, None])
+    num_sta_ub = np.sum(res < self.max_res + slack, axis=0).ravel()
+    # refine cells with the same bound together, from high to low
+    num_sta, best_nodes, best_res = 0, [], []
+    for num_ub in range(np.amax(num_sta_ub), self.min_sta-1, -1):
+        if num_ub < num_sta: break
+        cells = np.flatnonzero(num_sta_ub == num_ub)
+        if len(cells)==0: continue
+        # fine nodes in cells
+        z, cx, cy = np.unravel_index(cells, tt_coarse.shape[1:])
+        dxy = np.arange(f)
+        xs = cx[:,None,None]*f + dxy[None,:,None]
+        ys = cy[:,None,None]*f + dxy[None,None,:]
+        nodes = ((z[:,None,None]*nx + xs)*ny + ys)[(xs<nx) & (ys<ny)]
+        chunk = max(1, max_chunk_size // len(sta_idx))
+        for j in range(0, len(nodes), chunk):
+            nodes_j = nodes[j:j+chunk]
+            z, x, y = np.unravel_index(nodes_j, self.grid_shape)
+            res = abs(self.get_tt(sta_idx[:,None], z, x, y) - ttp_obs[:,None])
+            is_det = res < self.max_res
+            res[~is_det] = 0.
+            num_sta_j = np.sum(is_det, axis=0)
+            res_j = np.sum(res, axis=0)
+            # keep nodes with max num_sta
+            num_sta_max = np.amax(num_sta_j)
+            if num_sta_max < num_sta: continue
+            if num_sta_max > num_sta: num_sta, best_nodes, best_res = num_sta_max, [], []
+            to_keep = num_sta_j==num_sta
+            best_nodes.append(nodes_j[to_keep])
+            best_res.append(res_j[to_keep])
+    if num_sta < self.min_sta: return
+    # min res (first node for ties)
+    best_nodes, best_res = np.concatenate(best_nodes), np.concatenate(best_res)
+    best_res /= num_sta
+    res = np.amin(best_res)
+    zi, x, y = np.unravel_index(np.amin(best_nodes[best_res==res]), (nz, nx, ny))
+    return is_good, res, zi, x, y
+
+
+  # bad pick: no det on the grid, or not the first det pick of its sta
+  def get_good_picks(self, sta_idx, has_det, det_sta):
+    good_idx = []
+    for i, sta_idx_i in enumerate(sta_idx):
+        if not has_det[i] or sta_idx_i in det_sta: continue
+        det_sta.add(sta_idx_i)
+        good_idx.append(i)
+    return np.array(good_idx, dtype=int)
+
+
+  # coarse time table (at cell centers), tt range of each z layer, and slack for coarse search
+  def calc_tt_coarse(self):
+    f = self.coarse_factor
+    nz, nx, ny = self.grid_shape
+    # max tt diff between adjacent nodes; bigger than 2*max_res: tt range can't tell has_det
+    tt_step = 111 * self.xy_grid / self.v_min
+    if tt_step >= 2*self.max_res - 1e-3:
+        print('xy_grid too coarse, use exhaustive grid search')
+        return
+    cx = np.minimum(np.arange(0, nx, f) + f//2, nx-1)
+    cy = np.minimum(np.arange(0, ny, f) + f//2, ny-1)
+    sta_idx = np.arange(len(self.sta_list))
+    tt_coarse = self.get_tt(sta_idx[:,None,None,None], np.arange(nz)[None,:,None,None], 
+                            cx[None,None,:,None], cy[None,None,None,:])
+    tt_min, tt_max = np.zeros((2, len(sta_idx), nz), dtype=self.tt_dtype)
+    for i in sta_idx:
+        tt_i = self.get_tt(i, *self.grid_idx)
+        tt_min[i], tt_max[i] = np.amin(tt_i, axis=(1,2)), np.amax(tt_i, axis=(1,2))
+    # max tt diff between a cell center and nodes in the cell
+    slack = tt_step * (f//2) * np.sqrt(1 + self.cos_lat**2) + 1e-3
+    return tt_coarse, tt_min, tt_max, slack
+
+
+  # preallocated buffers for assoc_loc (allocated on first use, reused between events)
+  def get_loc_buf(self, max_buf_bytes=2**26):
+    grid_shape = self.grid_shape
+    if self.loc_buf is None or self.loc_buf[2].shape != grid_shape:
+        grid_bytes = np.prod(grid_shape) * np.dtype(self.tt_dtype).itemsize
+        chunk = int(max(1, min(self.loc_chunk, max_buf_bytes // grid_bytes)))
+        res_buf = np.zeros((chunk+1,) + grid_shape, dtype=self.tt_dtype)
+        det_buf = np.zeros((chunk+1,) + grid_shape, dtype=np.int32)
+        res_ttp_mat = np.zeros(grid_shape, dtype=self.tt_dtype)
+        num_sta_mat = np.zeros(grid_shape, dtype=np.int32)
+        self.loc_buf = [res_buf, det_buf, res_ttp_mat, num_sta_mat]
+    return self.loc_buf
+
+
+  # set x-y grid: sta range + margin
+  def calc_grid(self):
+    lat = [sta_loc[0] for sta_loc in self.sta_dict.values()]
+    lon = [sta_loc[1] for sta_loc in self.sta_dict.values()]
+    lon_margin = self.xy_margin * (np.amax(lon) - np.amin(lon))
+    lat_margin = self.xy_margin * (np.amax(lat) - np.amin(lat))
+    self.lon_range = [np.amin(lon)-lon_margin, np.amax(lon)+lon_margin]
+    self.lat_range = [np.amin(lat)-lat_margin, np.amax(lat)+lat_margin]
+    self.x_num = int((self.lon_range[1]-self.lon_range[0]) / self.xy_grid)
+    self.y_num = int((self.lat_range[1]-self.lat_range[0]) / self.xy_grid)
+    self.sta_list = list(self.sta_dict.keys())
+    self.sta_idx = {net_sta: i for i, net_sta in enumerate(self.sta_list)}
+    self.grid_shape = (len(self.z_grids), self.x_num, self.y_num)
+    self.grid_idx = np.ix_(*[np.arange(n) for n in self.grid_shape])
+    # convert sta loc to x-y grid_idx
+    self.cos_lat = np.cos(np.mean(self.lat_range) * np.pi/180)
+    self.sta_loc = np.array([self.sta_dict[net_sta][0:3] for net_sta in self.sta_list], dtype=float)
+    self.sta_x = ((self.sta_loc[:,1]-self.lon_range[0]) / self.xy_grid).astype(int)
+    self.sta_y = ((self.sta_loc[:,0]-self.lat_range[0]) / self.xy_grid).astype(int)
+
+
+  # calc time table: (n_sta, nz, nx, ny) array & tt_dict view for each sta
+  def calc_tt(self):
+    print('making time table')
+    self.calc_grid()
+    sta_loc, sta_x, sta_y = self.sta_loc, self.sta_x, self.sta_y
+    # calc P travel time: broadcast (n_sta, nz, nx, ny)
+    x, y = np.arange(self.x_num), np.arange(self.y_num)
+    dx = 111 * (x[None,:] - sta_x[:,None]) * self.xy_grid * self.cos_lat # degree to km
+    dy = 111 * (y[None,:] - sta_y[:,None]) * self.xy_grid
+    dz = np.array(self.z_grids)[None,:] + sta_loc[:,2:3]/1000.
+    dx2 = (dx**2).astype(self.tt_dtype)[:, None, :, None]
+    dy2 = (dy**2).astype(self.tt_dtype)[:, None, None, :]
+    dz2 = (dz**2).astype(self.tt_dtype)[:, :, None, None]
+    tt_table = dx2 + dy2 + dz2
+    np.sqrt(tt_table, out=tt_table)
+    tt_table /= self.tt_dtype(self.vp)
+    self.tt_table = tt_table
+    return {net_sta: tt_table[i] for i, net_sta in enumerate(self.sta_list)}
+
+
+  # load time table from cache (memory-mapped, read-only); calc & save if missing
+  def load_tt(self, tt_cache_dir):
+    # cache key: sta loc, grid params, vp & dtype
+    tt_key = [[net_sta] + [float(v) for v in self.sta_dict[net_sta][0:3]] for net_sta in self.sta_dict]
+    tt_key += [float(self.xy_margin), float(self.xy_grid), [float(z) for z in self.z_grids],
+               float(self.vp), np.dtype(self.tt_dtype).str]
+    tt_path = os.path.join(tt_cache_dir, 'tt_{}.npy'.format(hash_key(tt_key)))
+    if not os.path.exists(tt_path):
+        tt_dict = self.calc_tt()
+        if not os.path.exists(tt_cache_dir): os.makedirs(tt_cache_dir, exist_ok=True)
+        atomic_save(tt_path, self.tt_table)
+        print('time table saved: {}'.format(tt_path))
+        return tt_dict
+    print('loading time table: {}'.format(tt_path))
+    self.calc_grid()
+    self.tt_table = np.load(tt_path, mmap_mode='r')
+    return {net_sta: self.tt_table[i] for i, net_sta in enumerate(self.sta_list)}
+
+
+  # 1-D lookup table (nz, n_ele, n_dist): tt vs. epicentral dist & sta ele, for each z grid
+  #   one table for all sta; tt of sta is interpolated from it when needed (get_tt)
+  def calc_tt_lookup(self, vel, top, dist_step=0.1, ele_step=0.05):
+    print('making 1-D lookup time table')
+    self.calc_grid()
+    self.v_min = np.amin(vel)
+    x, y = np.arange(self.x_num), np.arange(self.y_num)
+    self.sta_dx = 111 * (x[None,:] - self.sta_x[:,None]) * self.xy_grid * self.cos_lat
+    self.sta_dy = 111 * (y[None,:] - self.sta_y[:,None]) * self.xy_grid
+    max_dist = np.sqrt(np.amax(self.sta_dx**2) + np.amax(self.sta_dy**2))
+    dist = np.arange(int(max_dist / dist_step) + 2) * dist_step
+    # ele grids to cover all sta
+    sta_ele = self.sta_loc[:,2] / 1000.
+    ele0 = np.floor(np.amin(sta_ele) / ele_step) * ele_step
+    num_ele = max(int(np.ceil((np.amax(sta_ele) - ele0) / ele_step)) + 1, 2)
+    ele = ele0 + np.arange(num_ele) * ele_step
+    ele_idx = np.minimum(((sta_ele - ele0) / ele_step).astype(int), num_ele-2)
+    self.sta_ele_idx, self.sta_ele_w = ele_idx, (sta_ele - ele[ele_idx]) / ele_step
+    # depth relative to ref ele (zero depth of vel_mod)
+    tt_lookup = np.zeros((len(self.z_grids), num_ele, len(dist)))
+    for i, z in enumerate(self.z_grids):
+        for j, ele_j in enumerate(ele):
+            tt_lookup[i,j] = calc_tt_1d(vel, top, z + self.ref_ele, self.ref_ele - ele_j, dist)
+    self.dist_step = dist_step
+    return tt_lookup
+
+
+  # P travel time of sta at grid nodes (z, x, y); all indices are broadcast together
+  def get_tt(self, sta_idx, z, x, y):
+    if self.tt_table is not None: return self.tt_table[sta_idx, z, x, y]
+    # interp lookup table: linear in dist & sta ele
+    dist = np.sqrt(self.sta_dx[sta_idx, x]**2 + self.sta_dy[sta_idx, y]**2) / self.dist_step
+    dist_idx = np.minimum(dist.astype(int), self.tt_lookup.shape[2]-2)
+    dist_w = dist - dist_idx
+    ele_w = self.sta_ele_w[sta_idx]
+    num_ele, num_dist = self.tt_lookup.shape[1:]
+    idx = (z * num_ele + self.sta_ele_idx[sta_idx]) * num_dist + dist_idx # flat idx
+    tt = self.tt_lookup.ravel()
+    tt0 = (1-ele_w) * tt.take(idx) + ele_w * tt.take(idx + num_dist)
+    tt1 = (1-ele_w) * tt.take(idx + 1) + ele_w * tt.take(idx + num_dist + 1)
+    return ((1-dist_w) * tt0 + dist_w * tt1).astype(self.tt_dtype)
+
+
+  # max P travel time over all grids & stations (farthest grids: xy corners)
+  def get_max_tt(self):
+    nz, nx, ny = self.grid_shape
+    sta_idx = np.arange(len(self.sta_list))[:,None,None,None]
+    z = np.arange(nz)[None,:,None,None]
+    x = np.array([0, nx-1])[None,None,:,None]
+    y = np.array([0, ny-1])[None,None,None,:]
+    return float(np.amax(self.get_tt(sta_idx, z, x, y)))
+
+
+class TS_Assoc_Tiled(TS_Assoc_Base):
+  """ Tiled TS_Assoc for large station networks
+    station region is split into tiles (tile_size), each extended by tile_overlap on all sides;
+    each tile is a TS_Assoc with its own small grid over its sub-network (>= min_sta stations)
+    ot assoc on all picks --> each cluster is located only in the tiles of its stations
+    --> one event per cluster: tile with the most associated picks (then min res)
+  Inputs
+    sta_dict: station location dict
+    tile_size, tile_overlap: tile width & extension on each side (in degree)
+    ot_dev, min_sta & assoc_params: params of TS_Assoc (for all tiles)
+    picks: numeric picks, sta indexed as in sta_dict (as for TS_Assoc)
+  Usage
+    import associator_pal
+    associator = associator_pal.TS_Assoc_Tiled(sta_dict, tile_size=2., tile_overlap=0.5)
+    associator.associate(picks, out_ctlg, out_pha)
+  """
+
+  def __init__(self, sta_dict, tile_size=2., tile_overlap=0.5, ot_dev=2.5, min_sta=4, **assoc_params):
+    self.sta_dict = sta_dict
+    self.ot_dev   = ot_dev
+    self.min_sta  = min_sta
+    self.sta_list = list(sta_dict.keys())
+    self.sta_idx  = {net_sta: i for i, net_sta in enumerate(self.sta_list)}
+    self.sta_loc  = np.array([sta_dict[net_sta][0:3] for net_sta in self.sta_list], dtype=float)
+    # split station region into tiles
+    lat, lon = self.sta_loc[:,0], self.sta_loc[:,1]
+    num_lat = max(1, int(np.ceil((np.amax(lat) - np.amin(lat)) / tile_size)))
+    num_lon = max(1, int(np.ceil((np.amax(lon) - np.amin(lon)) / tile_size)))
+    self.tiles = []     # (TS_Assoc, sta idx (in sta_list) of tile sta)
+    self.tile_map = []  # sta idx --> idx in tile sta (-1 if not in tile)
+    self.sta_tiles = [[] for _ in self.sta_list] # tiles of each sta
+    tile_stas = set()
+    for i, j in [(i, j) for i in range(num_lat) for j in range(num_lon)]:
+        lat0 = np.amin(lat) + i*tile_size - tile_overlap
+        lon0 = np.amin(lon) + j*tile_size - tile_overlap
+        lat1, lon1 = lat0 + tile_size + 2*tile_overlap, lon0 + tile_size + 2*tile_overlap
+        sta_idx = np.where((lat>=lat0) & (lat<=lat1) & (lon>=lon0) & (lon<=lon1))[0]
+        if len(sta_idx)<min_sta or tuple(sta_idx) in tile_stas: continue
+        tile_stas.add(tuple(sta_idx))
+        print('tile {}: {} stations, lat {:.2f}-{:.2f}, lon {:.2f}-{:.2f}'.format(
+            len(self.tiles), len(sta_idx), lat0, lat1, lon0, lon1))
+        tile_dict = {self.sta_list[k]: sta_dict[self.sta_list[k]] for k in sta_idx}
+        tile = TS_Assoc(tile_dict, ot_dev=ot_dev, min_sta=min_sta, **assoc_params)
+        tile_map = -np.ones(len(self.sta_list), dtype=np.int32)
+        tile_map[sta_idx] = np.arange(len(sta_idx))
+        for k in sta_idx: self.sta_tiles[k].append(len(self.tiles))
+        self.tiles.append((tile, sta_idx))
+        self.tile_map.append(tile_map)
+
+
+  # spatial assoc in tiles of the cluster sta: event_pick --> event_loc
+  def assoc_loc(self, event_pick):
+    tile_ids = sorted(set([k for sta in np.unique(event_pick['sta']) for k in self.sta_tiles[sta]]))
+    best = None
+    for k in tile_ids:
+        tile, tile_map = self.tiles[k][0], self.tile_map[k]
+        is_in = tile_map[event_pick['sta']] >= 0
+        if np.sum(is_in) < self.min_sta: continue
+        tile_pick = event_pick[is_in]
+        tile_pick['sta'] = tile_map[tile_pick['sta']]
+        event_loc, tile_pick = tile.assoc_loc(tile_pick)
+        if len(event_loc)==0: continue
+        score = (len(tile_pick), -event_loc['res'])
+        if best is None or score > best[0]: best = (score, event_loc, tile_pick, k)
+    if best is None: return [],[]
+    _, event_loc, tile_pick, k = best
+    tile_pick['sta'] = self.tiles[k][1][tile_pick['sta']]
+    return event_loc, tile_pick
+
+
+  def get_max_tt(self):
+    return max([tile.get_max_tt() for tile, _ in self.tiles])
+
+
+class TS_Assoc_Stream(object):
+  """ Online (streaming) mode of TS_Assoc
+    feed picks one by one or in small batches, as they are picked --> events
+    picks are kept in a sliding window of sta_ot; the window is associated as a time shard 
+    (see TS_Assoc.associate_shard) once no later pick can join its events
+  Inputs
+    associator: TS_Assoc obj (assoc params & time table)
+    out_ctlg, out_pha: file obj to write catalog & phase (optional)
+    max_delay: max delay (sec) of a pick after its sta_ot; default 2x max P travel time (>S travel time)
+    halo: overlap (sec) of consecutive shards; default 5*ot_dev
+    step: min time (sec) between associations
+  Outputs
+    events & event_picks (as TS_Assoc.associate) emitted in each feed
+  Usage
+    import associator_pal
+    associator = associator_pal.TS_Assoc(sta_dict)
+    stream_assoc = associator_pal.TS_Assoc_Stream(associator, out_ctlg, out_pha)
+    for picks in pick_batches: events, event_picks = stream_assoc.feed(picks)
+    events, event_picks = stream_assoc.flush()
+  *note: emission latency ~ max_delay + halo + step; window (memory) is bounded by the same time span
+  """
+
+  def __init__(self, associator, out_ctlg=None, out_pha=None, max_delay=None, halo=None, step=10.):
+    self.associator = associator
+    self.out_ctlg   = out_ctlg
+    self.out_pha    = out_pha
+    self.max_delay  = max_delay if max_delay is not None else 2 * associator.get_max_tt()
+    self.halo       = halo if halo is not None else 5 * associator.ot_dev
+    self.step       = step
+    self.reset()
+
+  def reset(self):
+    self.picks = None   # window of picks not yet emitted (struct np.array)
+    self.t_emit = None  # events with ot before t_emit are emitted
+    self.now = None     # latest ts of fed picks
+
+  # feed new picks (struct np.array of data_pipeline.pick_dtype, or one pick of it)
+  def feed(self, picks):
+    picks = np.atleast_1d(picks)
+    if len(picks)==0: return [], []
+    if self.picks is None: 
+        self.picks = picks[0:0]
+        self.t_emit = float(np.amin(picks['sta_ot'])) - self.halo
+        self.now = float(np.amax(picks['ts']))
+    # drop late picks (their window is emitted)
+    is_late = picks['sta_ot'] < self.t_emit - self.halo
+    if np.any(is_late): print('drop {} late picks'.format(np.sum(is_late)))
+    self.picks = np.append(self.picks, picks[~is_late])
+    self.now = max(self.now, float(np.amax(picks['ts'])))
+    # all picks with sta_ot < now - max_delay have arrived
+    t_emit = self.now - self.max_delay - self.halo
+    if t_emit - self.t_emit < self.step: return [], []
+    return self.emit(t_emit)
+
+  # associate & emit all remaining events
+  def flush(self):
+    if self.picks is None or len(self.picks)==0: return [], []
+    return self.emit(float(np.amax(self.picks['sta_ot'])) + self.halo)
+
+  # associate shard [t_emit_old, t_emit) --> events; slide window
+  def emit(self, t_emit):
+    events, event_picks = self.associator.associate_shard(self.picks, self.t_emit, t_emit, self.halo)
+    for event_loc, event_pick in zip(events, event_picks):
+        if self.out_ctlg: self.associator.write_catalog(event_loc, self.out_ctlg)
+        if self.out_pha: self.associator.write_phase(event_loc, event_pick, self.out_pha)
+    self.t_emit = t_emit
+    self.picks = self.picks[self.picks['sta_ot'] >= t_emit - self.halo]
+    return events, event_picks
+
+
+# epoch time (sec) to int us
+def sec_to_us(t):
+    return np.round(np.asarray(t) * 1e6).astype(np.int64)
+
+
+# min ns diff d with UTCDateTime diff round(d/1e9, 6) >= dt (> dt if strict)
+def sec_to_ns(dt, strict=False):
+    ns = max(int(dt*1e9) - 2000, 0)
+    while round(ns/1e9, 6) < dt or (strict and round(ns/1e9, 6)==dt): ns += 1
+    return ns
+
+
+# read 1-D layered velocity model in CRE format (hypoInverse)
+#   title line, then one line per layer: velocity (km/s) & depth of layer top (km)
+def read_vel_mod(fmod):
+    with open(fmod) as f: lines = f.readlines()[1:]
+    vel_mod = np.array([[float(v) for v in line.split()[0:2]] for line in lines if line.strip()])
+    return vel_mod[:,0], vel_mod[:,1]
+
 
+# P first arrival (direct & head waves) in 1-D layered model
+#   src & rcv depth relative to the model top; rcv above the top is taken in the 1st layer
+def calc_tt_1d(vel, top, z_src, z_rcv, dist, num_p=2000):
+    z0, z1 = min(z_src, z_rcv), max(z_src, z_rcv)
+    lay_top = np.append(-np.inf, top[1:])
+    lay_bot = np.append(top[1:], np.inf)
+    # direct wave: shoot rays with ray param p in [0, 1/v_max)
+    h = np.maximum(np.minimum(lay_bot, z1) - np.maximum(lay_top, z0), 0.)
+    vel_h, h = vel[h>0], h[h>0]
+    if len(h)==0: 
+        tt = dist / vel[max(np.searchsorted(top, z0, 'right')-1, 0)]
+    else:
+        v_max = np.amax(vel_h)
+        p = np.sin(np.linspace(0, np.pi/2, num_p, endpoint=False))[:,None] / v_max
+        q = np.sqrt(1/vel_h**2 - p**2) # vertical slowness
+        ray_x = np.sum(h * p / q, axis=1)
+        ray_t = np.sum(h / (vel_h**2 * q), axis=1)
+        tt = np.where(dist <= ray_x[-1], np.interp(dist, ray_x, ray_t), ray_t[-1] + (dist - ray_x[-1]) / v_max)
+    # head waves along layer tops below src & rcv
+    for k in range(1, len(vel)):
+        if top[k] < z1: continue
+        h = np.maximum(np.minimum(lay_bot, top[k]) - np.maximum(lay_top, z0), 0.) \
+          + np.maximum(np.minimum(lay_bot, top[k]) - np.maximum(lay_top, z1), 0.)
+        vel_h, h = vel[h>0], h[h>0]
+        if np.any(vel_h >= vel[k]): continue
+        q = np.sqrt(1/vel_h**2 - 1/vel[k]**2)
+        dist_crit = np.sum(h / (vel[k] * q))
+        tt_head = dist / vel[k] + np.sum(h * q)
+        tt = np.where(dist >= dist_crit, np.minimum(tt, tt_head), tt)
+    return tt
@@ -0,0 +1,78 @@
+""" Micro-benchmarks for picker engines
+    usage: python bench_picker.py
+"""
+import time
+import numpy as np
+from scipy.stats import kurtosis
+import picker_pal
+import config
+
+cfg = config.Config()
+samp_rate = 100.
+num_repeat = 5
+picker = picker_pal.STA_LTA_Kurtosis()
+
+# synthetic S-window energy trace: noise --> P coda --> S arrival
+def make_energy(npts, seed=0):
+    rng = np.random.RandomState(seed)
+    t = np.arange(npts)
+    amp = 1. + 10 * np.exp(-t/200.) + 60 * (t>npts//2) * np.exp(-(t-npts//2)/300.)
+    data = (rng.randn(npts) * amp)**2
+    return data / np.amax(data)
+
+def run_time(func, *args):
+    t0 = time.time()
+    for _ in range(num_repeat): out = func(*args)
+    return (time.time()-t0) / num_repeat, out
+
+# reference: scipy.stats.kurtosis per sample
+def calc_kurtosis_loop(data, win_kurt_npts):
+    npts = len(data) - win_kurt_npts + 1
+    kurt = np.zeros(npts)
+    for i in range(npts):
+        kurt[i] = kurtosis(data[i:i+win_kurt_npts])
+    return kurt
+
+def bench_kurtosis():
+    print('kurtosis (win_kurt={}s, {}Hz)'.format(cfg.win_kurt, samp_rate))
+    for win in cfg.win_kurt:
+        win_npts = int(win * samp_rate)
+        data = make_energy(win_npts + int(cfg.s_win * samp_rate))
+        t_loop, kurt_loop = run_time(calc_kurtosis_loop, data, win_npts)
+        t_vec, kurt_vec = run_time(picker.calc_kurtosis, data, win_npts)
+        max_dev = np.nanmax(abs(kurt_loop - kurt_vec))
+        print('  win {:>4} npts | loop {:.4f}s | vec {:.5f}s | x{:.0f} | max dev {:.1e}'\
+            .format(win_npts, t_loop, t_vec, t_loop/t_vec, max_dev))
+
+# reference: np.cov & np.linalg.eig per sample
+def calc_pca_filter_loop(data, idx_p, pca_range_npts, pca_win_npts):
+    def calc_pol(mat):
+        eig_val, eig_vec = np.linalg.eig(np.cov(mat))
+        lam1 = abs(np.amax(eig_val))
+        lam23 = abs(np.sum(eig_val) - lam1)
+        return 1 - (0.5 * lam23 / lam1), eig_vec.T[np.argmax(eig_val)]
+    p_r, p_v = calc_pol(data[:, idx_p : idx_p + pca_win_npts])
+    idx_range = range(idx_p - pca_range_npts[0], idx_p + pca_range_npts[1])
+    pca_filter = np.zeros(len(idx_range))
+    for i, idx in enumerate(idx_range):
+        s_r, s_v = calc_pol(data[:, idx : idx + pca_win_npts])
+        pca_filter[i] = 1 - s_r * abs(np.dot(p_v, s_v))
+    return pca_filter
+
+def bench_pca_filter():
+    print('pca filter (pca_win={}s, pca_range={}s, {}Hz)'.format(cfg.pca_win, cfg.pca_range, samp_rate))
+    pca_win_npts = int(cfg.pca_win * samp_rate)
+    pca_range_npts = [int(win * samp_rate) for win in cfg.pca_range]
+    rng = np.random.RandomState(0)
+    npts = int(cfg.s_win * samp_rate)
+    data = rng.randn(3, npts) * (1 + 20*(np.arange(npts) > npts//4))
+    idx_p = npts//8
+    t_loop, pca_loop = run_time(calc_pca_filter_loop, data, idx_p, pca_range_npts, pca_win_npts)
+    t_vec, pca_vec = run_time(picker.calc_pca_filter, data, idx_p, pca_range_npts, pca_win_npts)
+    max_dev = np.amax(abs(pca_loop - pca_vec))
+    print('  {} wins | loop {:.4f}s | vec {:.5f}s | x{:.0f} | max dev {:.1e}'\
+        .format(len(pca_vec), t_loop, t_vec, t_loop/t_vec, max_dev))
+
+if __name__ == '__main__':
+    bench_kurtosis()
+    bench_pca_filter()
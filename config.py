@@ -20,6 +20,9 @@ class Config(object):
     self.det_gap    = 5.            # time gap between detections
     self.to_prep    = True          # whether to preprocess the raw data
     self.freq_band  = [2,40]        # frequency band 
+    self.prep_float32 = False       # whether to preprocess in float32
+    self.prep_cache_dir = None      # dir to cache preprocessed data (None: no cache)
+    self.prep_cache_size = 50.      # max size of prep cache, in GB
 
     # 2. assoc params
     self.min_sta    = 4             # min num of stations to assoc
@@ -29,6 +32,12 @@ class Config(object):
     self.xy_grid    = 0.02          # lateral grid width, in degree
     self.z_grids    = np.arange(2,20,3)  # z (dep) grids
     self.vp         = 5.9           # averaged P velocity
+    self.tt_cache_dir = None        # dir to cache time table (None: no cache)
+    self.coarse_factor = 1          # num of xy_grid per coarse cell for loc search (1: exhaustive)
+    self.vel_mod    = None          # 1-D P velocity model (CRE file, as hypoInverse); None: use vp
+    self.ref_ele    = 0.            # ref elevation of vel_mod (km)
+    self.tile_size  = None          # tile width (degree) of tiled associator (None: one grid)
+    self.tile_overlap = 0.5         # tile extension on each side (degree)
 
     # 3. data interface
     self.get_data_dict = dp.get_data_dict
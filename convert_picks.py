@@ -0,0 +1,15 @@
+""" Convert text picks (YYYY-MM-DD.pick) into binary pick store (YYYY-MM-DD.picks)
+    picks --> picks (binary, columnar; read by data_pipeline.get_picks)
+"""
+import argparse
+import data_pipeline
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pick_dir', type=str,
+                        default='./output/picks')
+    parser.add_argument('--out_dir', type=str,
+                        default=None)
+    args = parser.parse_args()
+
+    data_pipeline.convert_picks(args.pick_dir, args.out_dir)
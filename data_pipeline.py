@@ -1,12 +1,16 @@
 """ Data Pipeline: interface for data i/o
 """
-import os, glob
+import os, glob, json, hashlib
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import obspy
 from obspy import read, UTCDateTime
 
-def get_data_dict(date, data_dir):
-    data_wholepath_list = get_data_filename_list(date, data_dir)
+def get_data_dict(date, data_dir, data_index=None):
+    if data_index: data_wholepath_list = get_data_filename_list_index(date, data_dir, data_index)
+    else: data_wholepath_list = get_data_filename_list(date, data_dir)
     data_dict = generate_filename_dictionary(data_wholepath_list)
     delete_bad_station(data_dict)
 
@@ -19,6 +23,15 @@ def get_data_filename_list(date, data_dir):
 
         return st_paths
 
+def get_data_filename_list_index(date, data_dir, data_index):
+        date_code = generate_date_pattern_YYYYMMDD(date)
+        conn = sqlite3.connect(data_index)
+        fnames = [row[0] for row in conn.execute('select path from files where day=?', (date_code,))]
+        conn.close()
+        st_paths = sorted([os.path.join(data_dir, fname) for fname in fnames])
+
+        return st_paths
+
 def generate_date_pattern_YYYYMMDD(date):
         date_pattern = '{:0>4}{:0>2}{:0>2}'.format(date.year, date.month, date.day)
 
@@ -67,14 +80,73 @@ def delete_bad_station(data_dict):
 
 
 
+""" waveform archive index (SQLite): header of each file in data_dir/YYYYMMDD/*
+    files: path (relative to data_dir), day, net_sta, chn, 
+           start_time & end_time (epoch sec), samp_rate, npts, size & mtime of file
+    built once & updated incrementally: only new or changed day dirs are scanned, removed ones are dropped
+"""
+def update_data_index(data_dir, data_index, rescan=False):
+    conn = sqlite3.connect(data_index)
+    conn.execute('create table if not exists days (day text primary key, mtime real)')
+    conn.execute('create table if not exists files (path text primary key, day text, net_sta text, chn text, '
+                 'start_time real, end_time real, samp_rate real, npts integer, size integer, mtime real)')
+    conn.execute('create index if not exists files_day on files (day)')
+    conn.execute('create index if not exists files_sta_time on files (net_sta, start_time)')
+    day_mtime = dict(conn.execute('select day, mtime from days'))
+    days = sorted([day for day in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, day))])
+    # drop deleted or moved day dirs
+    to_del = [(day,) for day in set(day_mtime) - set(days)]
+    conn.executemany('delete from files where day=?', to_del)
+    conn.executemany('delete from days where day=?', to_del)
+    conn.commit()
+    for day in days:
+        day_dir = os.path.join(data_dir, day)
+        mtime = os.path.getmtime(day_dir)
+        if not rescan and day_mtime.get(day)==mtime: continue
+        print('indexing data dir: {}'.format(day_dir))
+        indexed = {row[0]: row[1:] for row in conn.execute('select path, size, mtime from files where day=?', (day,))}
+        fnames = sorted(os.listdir(day_dir))
+        paths = [os.path.join(day, fname) for fname in fnames]
+        path_set = set(paths)
+        to_del = [(path,) for path in indexed if path not in path_set]
+        conn.executemany('delete from files where path=?', to_del)
+        for path, fname in zip(paths, fnames):
+            stat = os.stat(os.path.join(data_dir, path))
+            if indexed.get(path)==(stat.st_size, stat.st_mtime): continue
+            head = read_header(os.path.join(data_dir, path))
+            net_sta = get_netcode_and_station_name(fname)
+            conn.execute('replace into files values (?,?,?,?,?,?,?,?,?,?)', 
+                (path, day, net_sta) + head + (stat.st_size, stat.st_mtime))
+        conn.execute('replace into days values (?,?)', (day, mtime))
+        conn.commit()
+    conn.close()
+
+# read header of a data file --> (chn, start_time, end_time, samp_rate, npts); None for bad file
+def read_header(st_path):
+    try: head = read(st_path, headonly=True)[0].stats
+    except: return (None,)*5
+    return (head.channel, head.starttime.timestamp, head.endtime.timestamp, head.sampling_rate, head.npts)
+
+# query data index by time range & net_sta (optional)
+#   files overlapping [t0, t1) --> list of (path, net_sta, chn, start_time, end_time, samp_rate, npts)
+def query_data_index(data_dir, data_index, t0, t1, net_sta=None):
+    sql = 'select path, net_sta, chn, start_time, end_time, samp_rate, npts from files where start_time<? and end_time>=?'
+    args = (UTCDateTime(t1).timestamp, UTCDateTime(t0).timestamp)
+    if net_sta: sql += ' and net_sta=?'; args += (net_sta,)
+    conn = sqlite3.connect(data_index)
+    rows = conn.execute(sql + ' order by net_sta, start_time, path', args).fetchall()
+    conn.close()
+    return [(os.path.join(data_dir, row[0]),) + row[1:] for row in rows]
+
+
 # read stream data
 def read_data(st_paths, sta_dict):
     # read data
     print('reading stream: {}'.format(st_paths[0]))
     try:
-        st  = read(st_paths[0])
-        st += read(st_paths[1])
-        st += read(st_paths[2])
+        st  = read_mmap(st_paths[0])
+        st += read_mmap(st_paths[1])
+        st += read_mmap(st_paths[2])
     except: 
         print('bad data!'); return []
     # change header
@@ -87,17 +159,112 @@ def read_data(st_paths, sta_dict):
     for ii in range(3): st[ii].stats.network, st[ii].stats.station = net, sta
     # if format 1: same gain for 3-chn & time invariant
     if type(gain)==float:
-        for ii in range(3): st[ii].data = st[ii].data / gain
+        for ii in range(3): st[ii].data = apply_gain(st[ii].data, gain)
+    # if format 3: different gain for 3-chn & time variant (interval index)
+    elif isinstance(gain, GainIndex):
+        ge, gn, gz = gain.lookup(utc_to_sec(st_time))
+        for ii in range(3): st[ii].data = apply_gain(st[ii].data, float([ge,gn,gz][ii]))
     # if format 2: different gain for 3-chn & time invariant
     elif type(gain[0])==float:
-        for ii in range(3): st[ii].data = st[ii].data / gain[ii]
-    # if format 3: different gain for 3-chn & time variant
+        for ii in range(3): st[ii].data = apply_gain(st[ii].data, gain[ii])
+    # if format 3 as list of epochs
     elif type(gain[0])==list:
         for [ge,gn,gz,t0,t1] in gain:
             if t0<st_time<t1: break
-        for ii in range(3): st[ii].data = st[ii].data / [ge,gn,gz][ii]
+        for ii in range(3): st[ii].data = apply_gain(st[ii].data, [ge,gn,gz][ii])
+    return st
+
+# read one data file; SAC data are memory-mapped (copy-on-write: in-place ops never touch the file)
+#   header is read by obspy; other formats & unexpected file size fall back to obspy read
+def read_mmap(st_path):
+    try: st = read(st_path, format='SAC', headonly=True)
+    except: return read(st_path)
+    npts = st[0].stats.npts
+    if npts==0 or os.path.getsize(st_path)!=632+4*npts: return read(st_path)
+    # byte order from header version (nvhdr=6)
+    with open(st_path, 'rb') as f:
+        f.seek(304)
+        byte_order = '<' if np.frombuffer(f.read(4), dtype='<i4')[0]==6 else '>'
+    data = np.memmap(st_path, dtype=byte_order+'f4', mode='c', offset=632, shape=(npts,))
+    st[0].data = data if data.dtype.isnative else data.astype(np.float32)
     return st
 
+# divide data by gain, in place for float data
+def apply_gain(data, gain):
+    if not np.issubdtype(data.dtype, np.floating): return data / gain
+    data /= gain
+    return data
+
+# prefetch data in background threads: read_func(task) for upcoming tasks while the current one is processed
+#   at most num_prefetch tasks are read ahead; results are yielded in task order
+def prefetch_data(read_func, tasks, num_prefetch=2):
+    if num_prefetch<1:
+        for task in tasks: yield read_func(task)
+        return
+    pool = ThreadPoolExecutor(num_prefetch)
+    queue = deque()
+    try:
+        for task in tasks:
+            queue.append(pool.submit(read_func, task))
+            if len(queue)>num_prefetch: yield queue.popleft().result()
+        while queue: yield queue.popleft().result()
+    finally:
+        for future in queue: future.cancel()
+        pool.shutdown()
+
+
+class PrepCache(object):
+  """ On-disk cache of preprocessed (3, npts) data per station-day, memory-mapped when read
+    key: raw file identity (path, size, mtime) & params of read (e.g. sta gain) & preprocess
+    files: prep_<key>.npy (data) & prep_<key>.json (header); least recently used are evicted over max_size
+  Usage
+    prep_cache = PrepCache('output/prep_cache', max_size=50.)
+    key = prep_cache.get_key(st_paths, [get_gain_key(sta_dict[net_sta][3]), picker.to_prep, picker.freq_band, picker.prep_float32])
+    prep = prep_cache.get(key) # (st_data, net_sta, start_time, samp_rate) or None
+    if prep is None: prep_cache.put(key, *picker.prep_data(read_data(st_paths, sta_dict)))
+  """
+  def __init__(self, cache_dir, max_size=50.):
+    self.cache_dir = cache_dir
+    self.max_size = max_size # in GB
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+
+  def get_key(self, st_paths, prep_params):
+    return hash_key(file_identity(st_paths) + [prep_params])
+
+  def get(self, key):
+    data_path = os.path.join(self.cache_dir, 'prep_{}.npy'.format(key))
+    try:
+        with open(data_path[:-4] + '.json') as f: head = json.load(f)
+        st_data = np.load(data_path, mmap_mode='r')
+    except (OSError, ValueError): return
+    # mark as recently used
+    os.utime(data_path)
+    print('loading preprocessed data: {}'.format(data_path))
+    return st_data, head['net_sta'], UTCDateTime(ns=head['start_time']), head['samp_rate']
+
+  def put(self, key, st_data, net_sta, start_time, samp_rate):
+    data_path = os.path.join(self.cache_dir, 'prep_{}.npy'.format(key))
+    head = {'net_sta':net_sta, 'start_time':start_time.ns, 'samp_rate':samp_rate}
+    atomic_save(data_path[:-4] + '.json', json.dumps(head))
+    atomic_save(data_path, st_data)
+    self.evict()
+
+  # remove least recently used data until total size <= max_size
+  def evict(self):
+    data_paths = glob.glob(os.path.join(self.cache_dir, 'prep_*.npy'))
+    stats = []
+    for data_path in data_paths:
+        try: stats.append((os.path.getmtime(data_path), os.path.getsize(data_path), data_path))
+        except OSError: continue
+    total_size = sum([stat[1] for stat in stats])
+    for _, size, data_path in sorted(stats):
+        if total_size <= self.max_size * 1024**3: break
+        for path in [data_path, data_path[:-4] + '.json']:
+            try: os.remove(path)
+            except OSError: pass
+        total_size -= size
+
+
 # get station loc & gain dict
 def get_sta_dict(sta_file):
     sta_dict = {}
@@ -120,48 +287,294 @@ def get_sta_dict(sta_file):
             sta_dict[net_sta] = [lat,lon,ele,gain]
         else: 
             sta_dict[net_sta][-1].append(gain[0]) # if format 3
+    # format 3: interval index of gain epochs
+    for net_sta, sta_info in sta_dict.items():
+        gain = sta_info[3]
+        if type(gain)==list and type(gain[0])==list: sta_info[3] = GainIndex(gain)
     return sta_dict
 
-# get PAL picks (for assoc)
-def get_picks(date, pick_dir):
-    picks = []
-    dtype = [('net_sta','O'),
-             ('sta_ot','O'),
-             ('tp','O'),
-             ('ts','O'),
-             ('s_amp','O'),
-             ('p_snr','O'),
-             ('freq_dom','O')]
-    fname = str(date.date) + '.pick'
-    pick_path = os.path.join(pick_dir, fname)
-    if not os.path.exists(pick_path): return np.array([], dtype=dtype)
+# gain of sta_dict in json-able form (for cache & task keys)
+#   float, [ge, gn, gz] or list of epochs [ge, gn, gz, t0, t1] (t0 & t1 in epoch sec)
+def get_gain_key(gain):
+    if isinstance(gain, GainIndex): gain = gain.epochs
+    if type(gain)==list and type(gain[0])==list:
+        return [[float(g) for g in epoch[0:3]] + [utc_to_sec(t) for t in epoch[3:5]] for epoch in gain]
+    return gain
+
+# get 3-chn gains for many station-days at once --> (n,3) array
+#   times: UTCDateTime or epoch sec of each station-day (e.g. mid time)
+def get_gains(sta_dict, net_sta_list, times):
+    times = np.array([utc_to_sec(t) if isinstance(t, UTCDateTime) else t for t in times], dtype=np.float64)
+    net_sta_list = np.array(net_sta_list)
+    gains = np.zeros([len(times), 3])
+    for net_sta in np.unique(net_sta_list):
+        idx = np.where(net_sta_list==net_sta)[0]
+        gain = sta_dict[net_sta][3]
+        if isinstance(gain, GainIndex): gains[idx] = gain.lookup(times[idx])
+        else: gains[idx] = gain
+    return gains
+
+
+class GainIndex(object):
+  """ Interval index of time-variant gain epochs (format 3 sta_file)
+  Inputs
+    epochs: list of [ge, gn, gz, t0, t1] (t0 & t1 in UTCDateTime); epochs should not overlap
+  Usage
+    ge, gn, gz = gain.lookup(t) # t: epoch sec; epoch with t0 < t < t1, in O(log n)
+    gains = gain.lookup(t_arr) # (n,3) for t_arr of shape (n,)
+    time not in any epoch: gain of the last epoch (as listed in sta_file)
+  """
+  def __init__(self, epochs):
+    self.epochs = epochs
+    t0 = np.array([utc_to_sec(epoch[3]) for epoch in epochs])
+    order = np.argsort(t0, kind='stable')
+    self.t0 = t0[order]
+    self.t1 = np.array([utc_to_sec(epochs[i][4]) for i in order])
+    self.gains = np.array([epochs[i][0:3] for i in order], dtype=np.float64)
+    self.default = np.array(epochs[-1][0:3], dtype=np.float64)
+
+  def lookup(self, t):
+    t = np.asarray(t, dtype=np.float64)
+    idx = np.searchsorted(self.t0, t, side='left') - 1
+    idx_c = np.maximum(idx, 0)
+    is_in = (idx>=0) & (t<self.t1[idx_c])
+    return np.where(is_in[...,None], self.gains[idx_c], self.default)
+
+# numeric picks (picker_pal output & associator_pal input)
+#   sta: idx in sta_list; sta_ot, tp & ts: epoch time (sec, to us); attributes
+#   p_snr in float64: large snr keeps its digits in pick & phase files
+pick_dtype = [('sta', np.int32),
+              ('sta_ot', np.float64),
+              ('tp', np.float64),
+              ('ts', np.float64),
+              ('s_amp', np.float32),
+              ('p_snr', np.float64),
+              ('freq_dom', np.float32)]
+
+# get PAL picks (for assoc): binary pick store (YYYY-MM-DD.picks) or text (.pick); the newer if both exist
+#   sta_list: list of net_sta to index sta of picks; picks of other sta are dropped
+#   time_range: [t0, t1) of tp to return (optional)
+def get_picks(date, pick_dir, sta_list, time_range=None):
+    txt_path = os.path.join(pick_dir, str(date.date) + '.pick')
+    bin_path = txt_path + 's'
+    use_bin = os.path.exists(bin_path)
+    if use_bin and os.path.exists(txt_path):
+        use_bin = os.path.getmtime(os.path.join(bin_path, 'tp.npy')) >= os.path.getmtime(txt_path)
+    if use_bin: return get_picks_bin(bin_path, sta_list, time_range)
+    return get_picks_txt(txt_path, sta_list, time_range)
+
+# get picks from text pick file
+def get_picks_txt(pick_path, sta_list, time_range=None):
+    if not os.path.exists(pick_path): return np.array([], dtype=pick_dtype)
     f=open(pick_path); lines=f.readlines(); f.close()
-    for line in lines:
-        codes = line.split(',')
-        net_sta = codes[0]
-        sta_ot, tp, ts = [UTCDateTime(t) for t in codes[1:4]]
-        amp, p_snr, fd = [float(x) for x in codes[4:7]]
-        picks.append((net_sta, sta_ot, tp, ts, amp, p_snr, fd))
-    return np.array(picks, dtype=dtype)
+    codes = [line.split(',') for line in lines]
+    sta_idx = {net_sta: i for i, net_sta in enumerate(sta_list)}
+    picks = np.zeros(len(codes), dtype=pick_dtype)
+    picks['sta'] = [sta_idx.get(code[0], -1) for code in codes]
+    for i, col in enumerate(['sta_ot','tp','ts']): picks[col] = str_to_sec([code[i+1] for code in codes])
+    for i, col in enumerate(['s_amp','p_snr','freq_dom']): picks[col] = [float(code[i+4]) for code in codes]
+    picks = picks[picks['sta']>=0]
+    if time_range:
+        t0, t1 = [utc_to_sec(UTCDateTime(t)) for t in time_range]
+        picks = picks[(picks['tp']>=t0) * (picks['tp']<t1)]
+    return picks
+
+# ISO time strings (as written by UTCDateTime) to epoch time
+def str_to_sec(t_list):
+    t_list = np.array([t.strip().rstrip('Z') for t in t_list], dtype='datetime64[us]')
+    return t_list.astype(np.int64) / 1e6
+
+# UTCDateTime to epoch time (rounded to us, as in str)
+def utc_to_sec(t):
+    return round(t.ns, -3) // 1000 / 1e6
+
+# epoch time to UTCDateTime
+def sec_to_utc(t):
+    return UTCDateTime(ns=int(round(t*1e6))*1000)
+
+# epoch ns to epoch time (rounded to us, as in str)
+def ns_to_sec(ns):
+    us, ns = np.divmod(np.asarray(ns, dtype=np.int64), 1000)
+    us += (ns > 500) | ((ns == 500) & (us % 2 == 1))
+    return us / 1e6
+
+
+""" binary pick store: one dir per day (YYYY-MM-DD.picks), one .npy file per column
+    net_sta.npy: lookup table of net_sta; sta.npy: int32 code (idx in net_sta.npy)
+    sta_ot.npy, tp.npy, ts.npy: int64 epoch ns
+    s_amp.npy, freq_dom.npy: float32; p_snr.npy: float64
+    rows sorted by tp; columns are memory-mapped when read
+"""
+pick_cols = ['sta', 'sta_ot', 'tp', 'ts', 's_amp', 'p_snr', 'freq_dom']
+
+# write picks (list of pick tuples or pick array) into binary pick store
+#   sta_list: net_sta of sta idx in picks
+def write_picks_bin(picks, pick_path, sta_list):
+    picks = np.array(picks, dtype=pick_dtype)
+    sta_used, sta = np.unique(picks['sta'], return_inverse=True)
+    cols = {'sta': sta.astype(np.int32)}
+    for col in pick_cols[1:4]: cols[col] = np.round(picks[col] * 1e6).astype(np.int64) * 1000
+    for col in pick_cols[4:7]: cols[col] = picks[col]
+    order = np.argsort(cols['tp'], kind='stable')
+    if not os.path.exists(pick_path): os.makedirs(pick_path)
+    np.save(os.path.join(pick_path, 'net_sta.npy'), np.array([sta_list[i] for i in sta_used], dtype=str))
+    for col in pick_cols: np.save(os.path.join(pick_path, col + '.npy'), cols[col][order])
+
+# read columns of binary pick store (memory-mapped), sliced by time_range ([t0, t1) of tp)
+def read_picks_bin(pick_path, time_range=None):
+    cols = {col: np.load(os.path.join(pick_path, col + '.npy'), mmap_mode='r') for col in pick_cols}
+    cols['net_sta'] = np.load(os.path.join(pick_path, 'net_sta.npy'))
+    if time_range:
+        idx0, idx1 = np.searchsorted(cols['tp'], [UTCDateTime(t).ns for t in time_range])
+        for col in pick_cols: cols[col] = cols[col][idx0:idx1]
+    return cols
+
+# get picks from binary pick store, as in get_picks
+def get_picks_bin(pick_path, sta_list, time_range=None):
+    cols = read_picks_bin(pick_path, time_range)
+    picks = np.zeros(len(cols['tp']), dtype=pick_dtype)
+    picks['sta'] = remap_sta(cols['sta'], cols['net_sta'], sta_list)
+    for col in pick_cols[1:4]: picks[col] = ns_to_sec(cols[col])
+    for col in pick_cols[4:7]: picks[col] = cols[col]
+    return picks[picks['sta']>=0]
+
+# convert text picks (YYYY-MM-DD.pick) in pick_dir into binary pick store (in out_dir)
+def convert_picks(pick_dir, out_dir=None):
+    out_dir = out_dir or pick_dir
+    for pick_path in sorted(glob.glob(os.path.join(pick_dir, '*.pick'))):
+        out_path = os.path.join(out_dir, os.path.basename(pick_path) + 's')
+        print('converting {} --> {}'.format(pick_path, out_path))
+        f=open(pick_path); sta_list = sorted(set([line.split(',')[0] for line in f])); f.close()
+        write_picks_bin(get_picks_txt(pick_path, sta_list), out_path, sta_list)
+
+
+class BinPickWriter(object):
+  """ Write picks into binary pick store, as out_file of picker (written on close)
+  Usage
+    out_file = BinPickWriter('output/picks/2019-07-04.picks', picker.sta_list)
+    picker.pick(stream, out_file)
+    out_file.close()
+  """
+  def __init__(self, pick_path, sta_list):
+    self.pick_path = pick_path
+    self.sta_list = sta_list
+    self.picks = []
+
+  def write_pick(self, pick):
+    self.picks.append(tuple(pick))
+
+  def close(self):
+    write_picks_bin(self.picks, self.pick_path, self.sta_list)
+
+
+class RunManifest(object):
+  """ Manifest of finished work, for resumable & incremental runs of run_pick_assoc
+    json is written last: an entry exists only if complete
+    station-day (saved once its pick task finishes):
+      YYYY-MM-DD/NET.STA.json: task key; YYYY-MM-DD/NET.STA.npy: picks (pick_dtype; sta as 0)
+    day (saved after assoc):
+      YYYY-MM-DD.json: assoc key; YYYY-MM-DD.ctlg & .pha: catalog & phase of the day
+  Usage
+    manifest = RunManifest('output/picks/manifest')
+    task_key = hash_key([file_identity(st_paths), read_params, picker_params])
+    task_keys = manifest.load_task_keys(date) # dict by net_sta
+    picks = manifest.load_picks(date, net_sta, sta_list) # picks of one station-day
+    manifest.save_picks(date, net_sta, task_key, picks)
+    assoc = manifest.load_assoc(date) # (assoc_key, ctlg, pha); None if not finished
+    manifest.save_assoc(date, assoc_key, ctlg, pha)
+  """
+  def __init__(self, manifest_dir):
+    self.manifest_dir = manifest_dir
+    if not os.path.exists(manifest_dir): os.makedirs(manifest_dir, exist_ok=True)
+
+  def get_path(self, date):
+    return os.path.join(self.manifest_dir, str(date.date))
+
+  # task keys of finished station-days of the day, by net_sta
+  def load_task_keys(self, date):
+    task_keys = {}
+    for json_path in sorted(glob.glob(os.path.join(self.get_path(date), '*.json'))):
+        try:
+            with open(json_path) as f: task_keys[os.path.basename(json_path)[:-5]] = json.load(f)['task_key']
+        except (OSError, ValueError, KeyError): continue
+    return task_keys
+
+  # picks of a finished station-day (sta idx in sta_list; dropped if net_sta not in sta_list)
+  def load_picks(self, date, net_sta, sta_list):
+    picks = np.load(os.path.join(self.get_path(date), net_sta + '.npy'))
+    picks['sta'] = remap_sta(picks['sta'], [net_sta], sta_list)
+    return picks[picks['sta']>=0]
+
+  def save_picks(self, date, net_sta, task_key, picks):
+    day_dir = self.get_path(date)
+    if not os.path.exists(day_dir): os.makedirs(day_dir, exist_ok=True)
+    path = os.path.join(day_dir, net_sta)
+    picks = np.array(picks, dtype=pick_dtype)
+    picks['sta'] = 0
+    atomic_save(path + '.npy', picks)
+    atomic_save(path + '.json', json.dumps({'task_key':task_key}))
+
+  def load_assoc(self, date):
+    path = self.get_path(date)
+    try:
+        with open(path + '.json') as f: assoc_key = json.load(f)['assoc_key']
+        with open(path + '.ctlg') as f: ctlg = f.read()
+        with open(path + '.pha') as f: pha = f.read()
+    except (OSError, ValueError, KeyError): return
+    return assoc_key, ctlg, pha
+
+  def save_assoc(self, date, assoc_key, ctlg, pha):
+    path = self.get_path(date)
+    atomic_save(path + '.ctlg', ctlg)
+    atomic_save(path + '.pha', pha)
+    atomic_save(path + '.json', json.dumps({'assoc_key':assoc_key}))
+
+# identity of data files (path, size & mtime), to detect new or changed data
+def file_identity(st_paths):
+    return [[os.path.abspath(path), os.path.getsize(path), os.path.getmtime(path)] for path in st_paths]
+
+# short hash key of a json-able obj (np arrays & scalars as lists & numbers)
+def hash_key(obj):
+    obj = json.dumps(obj, default=lambda x: np.asarray(x).tolist())
+    return hashlib.sha1(obj.encode()).hexdigest()[0:16]
+
+# save text (str) or np array (.npy) to path: written to tmp file first, 
+#   so that readers (e.g. parallel workers) never see a partial file
+def atomic_save(path, data):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    if isinstance(data, str):
+        with open(tmp_path, 'w') as f: f.write(data)
+    else:
+        with open(tmp_path, 'wb') as f: np.save(f, data)
+    os.replace(tmp_path, path)
+
+# sta codes (idx in net_sta list) --> idx in sta_list; -1 for sta not in sta_list
+def remap_sta(sta, net_sta, sta_list):
+    sta_idx = {net_sta_i: i for i, net_sta_i in enumerate(sta_list)}
+    sta_map = np.array([sta_idx.get(net_sta_i, -1) for net_sta_i in net_sta] + [-1], dtype=np.int32)
+    return sta_map[sta]
+
 
 # get CERP picks (for assoc)
-def get_cerp_picks(date, pick_dir):
+def get_cerp_picks(date, pick_dir, sta_list):
     picks = []
-    dtype = [('net_sta','O'),
-             ('sta_ot','O'),
-             ('tp','O'),
-             ('ts','O'),
-             ('s_amp','O')]
+    dtype = [('sta', np.int32),
+             ('sta_ot', np.float64),
+             ('tp', np.float64),
+             ('ts', np.float64),
+             ('s_amp', np.float32)]
+    sta_idx = {net_sta: i for i, net_sta in enumerate(sta_list)}
     fname = str(date.date) + '.pick'
     pick_path = os.path.join(pick_dir, fname)
     f=open(pick_path); lines=f.readlines(); f.close()
     for line in lines:
         codes = line.split(',')
         net_sta = codes[0]
+        if net_sta not in sta_idx: continue
         tp, ts = [UTCDateTime(code) for code in codes[1:3]]
         sta_ot = calc_ot(tp, ts)
         s_amp = float(codes[3])
-        picks.append((net_sta, sta_ot, tp, ts, s_amp))
+        picks.append((sta_idx[net_sta], utc_to_sec(sta_ot), utc_to_sec(tp), utc_to_sec(ts), s_amp))
     return np.array(picks, dtype=dtype)
 
 def calc_ot(tp, ts):
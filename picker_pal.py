@@ -1,5 +1,8 @@
 import numpy as np
-from scipy.stats import kurtosis
+from scipy.signal import iirfilter, zpk2sos, sosfilt, sosfilt_zi, detrend
+from scipy.signal.windows import hann
+# output format of picks (numeric): data_pipeline.pick_dtype
+from data_pipeline import pick_dtype, utc_to_sec, sec_to_utc
 
 class STA_LTA_Kurtosis(object):
   """ STA/LTA based P&S Picker
@@ -19,13 +22,18 @@ class STA_LTA_Kurtosis(object):
     det_gap: time gap between detections
     to_prep: whether preprocess stream
     freq_band: frequency band for phase picking
+    prep_float32: preprocess (detrend, taper & filter) in float32
+    sta_list: list of net_sta, to index sta of picks (new sta are appended)
     *note: all time-related params are in sec
   Outputs
-    output to file or picks (struct np.array)
+    output to file or picks (struct np.array, pick_dtype)
   Usage
     import picker_pal
     picker = picker_pal.STA_LTA_Kurtosis()
     picks = picker.pick(stream)
+    picks = picker.pick_many(streams) # multi-station on stacked arrays
+    picks = picker.pick_many_data(preps) # multi-station on preprocessed data (outputs of prep_data)
+    picks = picker.pick_data(*picker.prep_data(stream)) # preprocess & pick in two steps
   """
 
   def __init__(self, 
@@ -41,7 +49,9 @@ class STA_LTA_Kurtosis(object):
                amp_win    = [1.,5.],
                det_gap    = 5.,
                to_prep    = True,
-               freq_band  = [1., 40]):
+               freq_band  = [1., 40],
+               prep_float32 = False,
+               sta_list   = None):
     self.win_sta    = win_sta
     self.win_lta    = win_lta
     self.trig_thres = trig_thres
@@ -55,142 +65,255 @@ class STA_LTA_Kurtosis(object):
     self.det_gap    = det_gap
     self.to_prep    = to_prep
     self.freq_band  = freq_band
+    self.prep_float32 = prep_float32
+    self.sos_cache  = {} # (samp_rate, freq_band) --> sos
+    self.sta_list   = list(sta_list) if sta_list else []
+    self.sta_idx    = {net_sta: i for i, net_sta in enumerate(self.sta_list)}
 
 
   def pick(self, stream, out_file=None):
-    # set output format
-    dtype = [('net_sta','O'),
-             ('sta_ot','O'),
-             ('tp','O'),
-             ('ts','O'),
-             ('s_amp','O'),
-             ('p_snr','O'),
-             ('freq_dom','O')]
-    # preprocess & extract data
-    if len(stream)!=3: return np.array([], dtype=dtype)
-    if self.to_prep: stream = self.preprocess(stream, self.freq_band)
-    if len(stream)!=3: return np.array([], dtype=dtype)
-    min_npts = min([len(trace) for trace in stream])
-    st_data = np.array([trace.data[0:min_npts] for trace in stream])
+    prep = self.prep_data(stream)
+    if prep is None: return np.array([], dtype=pick_dtype)
+    return self.pick_data(*prep, out_file=out_file)
+
+  # preprocess & extract data --> (st_data, net_sta, start_time, samp_rate); None for bad stream
+  #   aligned 3-chn data are preprocessed as one (3, npts) stack and returned without copy
+  def prep_data(self, stream):
+    if len(stream)!=3: return
+    if self.to_prep:
+        stream = self.align_fill(stream)
+        if len(stream)!=3: return
+        data = self.preprocess_traces(stream, self.freq_band)
+        if len(data)==0: return
+    else: data = [trace.data for trace in stream]
+    if isinstance(data, np.ndarray): st_data = data
+    else:
+        min_npts = min([len(data_i) for data_i in data])
+        st_data = np.array([data_i[0:min_npts] for data_i in data])
     # get header
     head = stream[0].stats
     net_sta = '.'.join([head.network, head.station])
-    samp_rate = head.sampling_rate
-    start_time, end_time = head.starttime, head.endtime
-    # sec to points
-    win_sta_npts   = [int(samp_rate * win) for win in self.win_sta]
-    win_lta_npts   = [int(samp_rate * win) for win in self.win_lta]
-    p_win_npts     = [int(samp_rate * win) for win in self.p_win]
-    s_win_npts     =  int(samp_rate * self.s_win)
-    pca_win_npts   =  int(samp_rate * self.pca_win)
-    pca_range_npts = [int(samp_rate * win) for win in self.pca_range]
-    win_kurt_npts  = [int(samp_rate * win) for win in self.win_kurt]
-    amp_win_npts   = [int(samp_rate * win) for win in self.amp_win]
-    det_gap_npts   =  int(samp_rate * self.det_gap)
-    # pick P and S
-    picks = []
+    return st_data, net_sta, head.starttime, head.sampling_rate
+
+  # pick on preprocessed (3, npts) data
+  def pick_data(self, st_data, net_sta, start_time, samp_rate, out_file=None):
+    end_time = start_time + (st_data.shape[1]-1) / samp_rate
     # 1. trig picker
     print('1. triggering phase picker')
-    cf_trig = self.calc_sta_lta(st_data[2]**2, win_lta_npts[0], win_sta_npts[0])
-    trig_index = np.where(cf_trig > self.trig_thres)[0]
-    slide_idx = 0
+    npts = self.get_npts(samp_rate)
+    cf_trig = self.calc_sta_lta(st_data[2]**2, npts['win_lta'][0], npts['win_sta'][0])
     # 2. phase picking
     print('2. picking phase:')
+    picks = self.pick_cf(st_data, cf_trig, net_sta, start_time, end_time, samp_rate, out_file)
+    # convert to structed np.array
+    return np.array(picks, dtype=pick_dtype)
+
+  # pick multiple stations: stations with the same samp_rate & npts are 
+  # preprocessed and triggered as stacked (n_sta, 3, npts) arrays
+  def pick_many(self, streams, out_file=None, batch_size=20):
+    # 1. time alignment & gap filling for each station
+    sta_list = []
+    for stream in streams:
+        if len(stream)!=3: continue
+        if self.to_prep: stream = self.align_fill(stream)
+        if len(stream)!=3: continue
+        min_npts = min([len(trace) for trace in stream])
+        st_data = np.array([trace.data[0:min_npts] for trace in stream])
+        sta_list.append((stream[0].stats, st_data))
+    # 2. stacked preprocess & trigger cf; phase picking for each sta
+    sta_picks = [[] for _ in sta_list]
+    keys = [(head.sampling_rate, st_data.shape[1]) for head, st_data in sta_list]
+    for samp_rate, batch_idx in self.get_batches(keys, batch_size):
+        data = np.array([sta_list[i][1] for i in batch_idx])
+        heads = [sta_list[i][0] for i in batch_idx]
+        for i in batch_idx: sta_list[i] = (sta_list[i][0], None)
+        if self.to_prep: data = self.preprocess_stack(data, samp_rate, self.freq_band)
+        if len(data)==0: continue
+        sta_heads = [('.'.join([head.network, head.station]), head.starttime) for head in heads]
+        for i, picks_i in zip(batch_idx, self.pick_stack(data, sta_heads, samp_rate)): sta_picks[i] = picks_i
+    # 3. output in input order
+    picks = [pick for picks_i in sta_picks for pick in picks_i]
+    if out_file: 
+        for pick in picks: self.write_pick(pick, out_file)
+    return np.array(picks, dtype=pick_dtype)
+
+  # pick multiple preprocessed stations (outputs of prep_data), as pick_many
+  def pick_many_data(self, preps, out_file=None, batch_size=20):
+    sta_picks = [[] for _ in preps]
+    keys = [(samp_rate, st_data.shape[1]) for st_data, _, _, samp_rate in preps]
+    for samp_rate, batch_idx in self.get_batches(keys, batch_size):
+        data = np.array([preps[i][0] for i in batch_idx])
+        sta_heads = [preps[i][1:3] for i in batch_idx]
+        for i, picks_i in zip(batch_idx, self.pick_stack(data, sta_heads, samp_rate)): sta_picks[i] = picks_i
+    picks = [pick for picks_i in sta_picks for pick in picks_i]
+    if out_file: 
+        for pick in picks: self.write_pick(pick, out_file)
+    return np.array(picks, dtype=pick_dtype)
+
+  # group sta by key (samp_rate, npts) --> (samp_rate, sta idx) for batches of <= batch_size sta
+  def get_batches(self, keys, batch_size):
+    groups = {}
+    for i, key in enumerate(keys):
+        if key not in groups: groups[key] = [i]
+        else: groups[key].append(i)
+    return [(key[0], sta_idx[idx0 : idx0 + batch_size]) 
+        for key, sta_idx in groups.items() for idx0 in range(0, len(sta_idx), batch_size)]
+
+  # trigger cf on stacked (n_sta, 3, npts) data; phase picking for each sta --> list of picks per sta
+  #   sta_heads: (net_sta, start_time) of each sta
+  def pick_stack(self, data, sta_heads, samp_rate):
+    npts = self.get_npts(samp_rate)
+    print('triggering phase picker: {} stations'.format(len(data)))
+    cf_trig = self.calc_sta_lta(data[:,2]**2, npts['win_lta'][0], npts['win_sta'][0])
+    sta_picks = []
+    for j, (net_sta, start_time) in enumerate(sta_heads):
+        end_time = start_time + (data.shape[2]-1) / samp_rate
+        sta_picks.append(self.pick_cf(data[j], cf_trig[j], net_sta, start_time, end_time, samp_rate))
+    return sta_picks
+
+  # phase picking on trigger cf for one station --> list of picks
+  def pick_cf(self, st_data, cf_trig, net_sta, start_time, end_time, samp_rate, out_file=None):
+    npts = self.get_npts(samp_rate)
+    picks = []
+    trig_index = np.where(cf_trig > self.trig_thres)[0]
+    slide_idx = 0
     for _ in trig_index:
         trig_idx = trig_index[slide_idx]
-        if trig_idx < p_win_npts[0] + max(win_lta_npts):
+        if trig_idx < npts['p_win'][0] + max(npts['win_lta']):
             slide_idx += 1; continue
-        # 2.1 pick P with STA/LTA
-        p_idx0 = trig_idx - p_win_npts[0] - win_lta_npts[1]
-        p_idx1 = trig_idx + p_win_npts[1] + win_sta_npts[1]
-        data_p = st_data[2,p_idx0:p_idx1]**2
-        cf_p = self.calc_sta_lta(data_p, win_lta_npts[1], win_sta_npts[1])
-        tp0_idx = np.argmax(cf_p) + p_idx0
-        dt_idx = self.find_second_peak(data_p[0:tp0_idx-p_idx0][::-1])
-        tp_idx = tp0_idx - dt_idx
-        tp = start_time + tp_idx / samp_rate
-        # 2.2 pick S 
-        # 2.2.1 pca for amp_peak
-        if len(st_data[0]) < tp_idx + s_win_npts: break
-        s_idx0 = tp_idx - pca_range_npts[0]
-        s_idx1 = max(tp_idx + s_win_npts, tp_idx + pca_range_npts[1])
-        data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)**0.5
-        pca_filter = self.calc_pca_filter(st_data, tp_idx, pca_range_npts, pca_win_npts)
-        data_s[0:len(pca_filter)] *= pca_filter
-        dt_peak = max(np.argmax(data_s)+1, pca_win_npts+1)
-        # 2.2.2 long_win kurt --> t_max
-        s_idx0 = tp_idx + dt_peak//2 - win_kurt_npts[0]
-        s_idx1 = tp_idx + dt_peak
-        data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
-        data_s /= np.amax(data_s)
-        kurt_long = self.calc_kurtosis(data_s, win_kurt_npts[0])
-        # 2.2.3 STA/LTA --> t_min
-        s_idx0 = tp_idx + dt_peak//2 - win_lta_npts[2]
-        s_idx1 = tp_idx + dt_peak + win_sta_npts[2]
-        data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
-        cf_s = self.calc_sta_lta(data_s, win_lta_npts[2], win_sta_npts[2])[win_lta_npts[2]:]
-        # 2.2.4 pick S on short_win kurt
-        dt_max = np.argmax(kurt_long) # relative to (tp_idx + dt_peak//2)
-        dt_max -= self.find_first_peak(kurt_long[0:dt_max+1][::-1])
-        dt_min = np.argmax(cf_s) # relative to (tp_idx + dt_peak//2)
-        # if kurt_long not stable, use STA/LTA
-        if dt_min>=dt_max: 
-            ts0_idx = tp_idx + dt_peak//2 + dt_min
-            dt_idx = self.find_second_peak(data_s[0:dt_min+win_lta_npts[2]][::-1])
-            ts_idx = ts0_idx - dt_idx
-        # else, pick peak of kurt_short
-        else:
-            s_idx0 = tp_idx + dt_peak//2 + dt_min - win_kurt_npts[1]
-            s_idx1 = tp_idx + dt_peak//2 + dt_max
-            data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
-            data_s /= np.amax(data_s)
-            kurt_short = self.calc_kurtosis(data_s, win_kurt_npts[1])
-            kurt_max = np.argmax(kurt_short) if np.argmax(kurt_short)>0 else dt_max-dt_min
-            ts0_idx = tp_idx + dt_peak//2 + dt_min + kurt_max
-            dt_idx = self.find_second_peak(data_s[0:s_idx0+win_kurt_npts[1]+kurt_max][::-1])
-            ts_idx = ts0_idx - dt_idx
-        ts = start_time + ts_idx / samp_rate
-        # 3 get related S amplitude
-        data_amp = st_data[:, tp_idx-amp_win_npts[0] : ts_idx+amp_win_npts[1]].copy()
-        s_amp = self.get_s_amp(data_amp, samp_rate)
-        # 4 get p_snr
-        p_snr = np.amax(cf_trig[p_idx0:p_idx1])
-        # 5 calc dominant frequency
-        t0 = min(tp, ts)
-        t1 = max(tp+(ts-tp)/2, tp+self.win_sta[0])
-        st = stream.slice(t0,t1).copy()
-        fd = max([self.calc_freq_dom(tr.data, samp_rate) for tr in st])
+        pick_i = self.pick_trig(st_data, cf_trig, trig_idx, npts, start_time, end_time, samp_rate)
+        if not pick_i: break
+        tp_idx, ts_idx, tp, ts, s_amp, p_snr, fd = pick_i
         # output
-        print('{}, {}, {}'.format(net_sta, tp, ts))
-        if tp<ts and fd>self.fd_thres:
-            sta_ot = self.calc_ot(tp, ts)
-            picks.append((net_sta, sta_ot, tp, ts, s_amp, p_snr, fd))
-            if out_file: 
-                pick_line = '{},{},{},{},{},{:.2f},{:.2f}\n'\
-                    .format(net_sta, sta_ot, tp, ts, s_amp, p_snr, fd)
-                out_file.write(pick_line)
+        pick = self.output_pick(net_sta, tp, ts, s_amp, p_snr, fd, out_file)
+        if pick: picks.append(pick)
         # next detected phase
-        rest_det = np.where(trig_index > max(trig_idx,ts_idx,tp_idx) + det_gap_npts)[0]
+        rest_det = np.where(trig_index > max(trig_idx,ts_idx,tp_idx) + npts['det_gap'])[0]
         if len(rest_det)==0: break
         slide_idx = rest_det[0]
-    # convert to structed np.array
-    return np.array(picks, dtype=dtype)
+    return picks
+
+  # sec to points
+  def get_npts(self, samp_rate):
+    npts = {}
+    npts['win_sta']   = [int(samp_rate * win) for win in self.win_sta]
+    npts['win_lta']   = [int(samp_rate * win) for win in self.win_lta]
+    npts['p_win']     = [int(samp_rate * win) for win in self.p_win]
+    npts['s_win']     =  int(samp_rate * self.s_win)
+    npts['pca_win']   =  int(samp_rate * self.pca_win)
+    npts['pca_range'] = [int(samp_rate * win) for win in self.pca_range]
+    npts['win_kurt']  = [int(samp_rate * win) for win in self.win_kurt]
+    npts['amp_win']   = [int(samp_rate * win) for win in self.amp_win]
+    npts['det_gap']   =  int(samp_rate * self.det_gap)
+    return npts
+
+  # pick P & S for one trigger: trig_idx --> (tp_idx, ts_idx, tp, ts, s_amp, p_snr, fd)
+  def pick_trig(self, st_data, cf_trig, trig_idx, npts, start_time, end_time, samp_rate):
+    win_sta_npts, win_lta_npts = npts['win_sta'], npts['win_lta']
+    win_kurt_npts, pca_win_npts = npts['win_kurt'], npts['pca_win']
+    # 2.1 pick P with STA/LTA
+    p_idx0 = trig_idx - npts['p_win'][0] - win_lta_npts[1]
+    p_idx1 = trig_idx + npts['p_win'][1] + win_sta_npts[1]
+    data_p = st_data[2,p_idx0:p_idx1]**2
+    cf_p = self.calc_sta_lta(data_p, win_lta_npts[1], win_sta_npts[1])
+    tp0_idx = np.argmax(cf_p) + p_idx0
+    dt_idx = self.find_second_peak(data_p[0:tp0_idx-p_idx0][::-1])
+    tp_idx = tp0_idx - dt_idx
+    # 2.2 pick S 
+    # 2.2.1 pca for amp_peak
+    if len(st_data[0]) < tp_idx + npts['s_win']: return
+    s_idx0 = tp_idx - npts['pca_range'][0]
+    s_idx1 = max(tp_idx + npts['s_win'], tp_idx + npts['pca_range'][1])
+    data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)**0.5
+    pca_filter = self.calc_pca_filter(st_data, tp_idx, npts['pca_range'], pca_win_npts)
+    data_s[0:len(pca_filter)] *= pca_filter
+    dt_peak = max(np.argmax(data_s)+1, pca_win_npts+1)
+    # 2.2.2 long_win kurt --> t_max
+    s_idx0 = tp_idx + dt_peak//2 - win_kurt_npts[0]
+    s_idx1 = tp_idx + dt_peak
+    data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
+    data_s /= np.amax(data_s)
+    kurt_long = self.calc_kurtosis(data_s, win_kurt_npts[0])
+    # 2.2.3 STA/LTA --> t_min
+    s_idx0 = tp_idx + dt_peak//2 - win_lta_npts[2]
+    s_idx1 = tp_idx + dt_peak + win_sta_npts[2]
+    data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
+    cf_s = self.calc_sta_lta(data_s, win_lta_npts[2], win_sta_npts[2])[win_lta_npts[2]:]
+    # 2.2.4 pick S on short_win kurt
+    dt_max = np.argmax(kurt_long) # relative to (tp_idx + dt_peak//2)
+    dt_max -= self.find_first_peak(kurt_long[0:dt_max+1][::-1])
+    dt_min = np.argmax(cf_s) # relative to (tp_idx + dt_peak//2)
+    # if kurt_long not stable, use STA/LTA
+    if dt_min>=dt_max: 
+        ts0_idx = tp_idx + dt_peak//2 + dt_min
+        dt_idx = self.find_second_peak(data_s[0:dt_min+win_lta_npts[2]][::-1])
+        ts_idx = ts0_idx - dt_idx
+    # else, pick peak of kurt_short
+    else:
+        s_idx0 = tp_idx + dt_peak//2 + dt_min - win_kurt_npts[1]
+        s_idx1 = tp_idx + dt_peak//2 + dt_max
+        data_s = np.sum(st_data[0:2, s_idx0:s_idx1]**2, axis=0)
+        data_s /= np.amax(data_s)
+        kurt_short = self.calc_kurtosis(data_s, win_kurt_npts[1])
+        kurt_max = np.argmax(kurt_short) if np.argmax(kurt_short)>0 else dt_max-dt_min
+        ts0_idx = tp_idx + dt_peak//2 + dt_min + kurt_max
+        dt_idx = self.find_second_peak(data_s[0:s_idx0+win_kurt_npts[1]+kurt_max][::-1])
+        ts_idx = ts0_idx - dt_idx
+    # 3 get related S amplitude
+    data_amp = st_data[:, tp_idx-npts['amp_win'][0] : ts_idx+npts['amp_win'][1]].copy()
+    s_amp = self.get_s_amp(data_amp, samp_rate)
+    # 4 get p_snr
+    p_snr = np.amax(cf_trig[p_idx0:p_idx1])
+    # 5 calc dominant frequency (nearest samples in [t0, t1], as stream.slice)
+    tp = start_time + tp_idx / samp_rate
+    ts = start_time + ts_idx / samp_rate
+    t0 = min(tp, ts)
+    t1 = max(tp+(ts-tp)/2, tp+self.win_sta[0])
+    dt1 = (t1 - end_time) * samp_rate
+    fd_idx0 = min(tp_idx, ts_idx)
+    fd_idx1 = len(st_data[0]) - 1 + int(np.sign(dt1) * np.floor(abs(dt1) + 0.5))
+    fd = max([self.calc_freq_dom(data.copy(), samp_rate) for data in st_data[:, fd_idx0:fd_idx1+1]])
+    return tp_idx, ts_idx, tp, ts, s_amp, p_snr, fd
 
-  # calc STA/LTA for a trace of data (abs or square)
+  # screen output & write pick; return pick if it passes QC
+  def output_pick(self, net_sta, tp, ts, s_amp, p_snr, fd, out_file=None):
+    print('{}, {}, {}'.format(net_sta, tp, ts))
+    if not (tp<ts and fd>self.fd_thres): return
+    sta_ot = self.calc_ot(tp, ts)
+    pick = (self.get_sta_idx(net_sta), utc_to_sec(sta_ot), utc_to_sec(tp), utc_to_sec(ts), s_amp, p_snr, fd)
+    if out_file: self.write_pick(pick, out_file)
+    return pick
+
+  # idx of sta in sta_list
+  def get_sta_idx(self, net_sta):
+    if net_sta not in self.sta_idx:
+        self.sta_idx[net_sta] = len(self.sta_list)
+        self.sta_list.append(net_sta)
+    return self.sta_idx[net_sta]
+
+  # write one pick line (or to pick store with write_pick, e.g. data_pipeline.BinPickWriter)
+  def write_pick(self, pick, out_file):
+    if hasattr(out_file, 'write_pick'): return out_file.write_pick(pick)
+    sta, sta_ot, tp, ts, s_amp, p_snr, fd = pick
+    sta_ot, tp, ts = [sec_to_utc(t) for t in [sta_ot, tp, ts]]
+    pick_line = '{},{},{},{},{},{:.2f},{:.2f}\n'.format(self.sta_list[sta], sta_ot, tp, ts, str(s_amp), p_snr, fd)
+    out_file.write(pick_line)
+
+  # calc STA/LTA for a trace of data (abs or square); stacked data: along last axis
   def calc_sta_lta(self, data, win_lta_npts, win_sta_npts):
-    npts = len(data)
+    npts = data.shape[-1]
     if npts < win_lta_npts + win_sta_npts:
         print('input data too short!')
-        return np.zeros(1)
-    sta = np.zeros(npts)
-    lta = np.ones(npts)
-    data_cum = np.cumsum(data)
-    sta[:-win_sta_npts] = data_cum[win_sta_npts:] - data_cum[:-win_sta_npts]
+        return np.zeros(1) if data.ndim==1 else np.zeros(data.shape)
+    sta = np.zeros(data.shape)
+    lta = np.ones(data.shape)
+    data_cum = np.cumsum(data, axis=-1)
+    sta[...,:-win_sta_npts] = data_cum[...,win_sta_npts:] - data_cum[...,:-win_sta_npts]
     sta /= win_sta_npts
-    lta[win_lta_npts:]  = data_cum[win_lta_npts:] - data_cum[:-win_lta_npts]
+    lta[...,win_lta_npts:]  = data_cum[...,win_lta_npts:] - data_cum[...,:-win_lta_npts]
     lta /= win_lta_npts
     sta_lta = sta/lta
-    sta_lta[0:win_lta_npts] = 0.
+    sta_lta[...,0:win_lta_npts] = 0.
     sta_lta[np.isinf(sta_lta)] = 0.
     sta_lta[np.isnan(sta_lta)] = 0.
     return sta_lta
@@ -199,24 +322,46 @@ class STA_LTA_Kurtosis(object):
   def calc_pca_filter(self, data, idx_p, pca_range_npts, pca_win_npts):
     p_mat = data[:, idx_p : idx_p + pca_win_npts]
     p_r, p_v = self.calc_pol(p_mat)
-    idx_range = range(idx_p - pca_range_npts[0],
-                      idx_p + pca_range_npts[1])
-    pca_filter = np.zeros(len(idx_range))
-    for i, idx in enumerate(idx_range):
-        s_mat = data[:, idx : idx + pca_win_npts]
-        s_r, s_v = self.calc_pol(s_mat)
-        abs_cos = abs(np.dot(p_v, s_v))
-        pca_filter[i] = 1 - s_r * abs_cos
-    return pca_filter
+    idx0 = idx_p - pca_range_npts[0]
+    num_win = pca_range_npts[0] + pca_range_npts[1]
+    s_mat = data[:, idx0 : idx0 + num_win + pca_win_npts - 1]
+    s_r, s_v = self.calc_pol_sliding(s_mat, pca_win_npts, num_win)
+    abs_cos = abs(np.dot(s_v, p_v))
+    return 1 - s_r * abs_cos
 
   # calc pol_rate & pol_vec
   def calc_pol(self, mat):
     cov = np.cov(mat)
-    eig_val, eig_vec = np.linalg.eig(cov)
-    lam1  = abs(np.amax(eig_val))
+    eig_val, eig_vec = np.linalg.eigh(cov)
+    lam1  = abs(eig_val[-1])
     lam23 = abs(np.sum(eig_val) - lam1)
     pol_rate = 1 - (0.5 * lam23 / lam1)
-    pol_vec = eig_vec.T[np.argmax(eig_val)]
+    pol_vec = eig_vec[:,-1]
+    return pol_rate, pol_vec
+
+  # calc pol_rate & pol_vec for sliding wins: cov from cumsum of cross-products
+  def calc_pol_sliding(self, mat, win_npts, num_win):
+    num_chn, npts = mat.shape
+    mat = mat - np.mean(mat, axis=1, keepdims=True)
+    # win len (truncated at the end of data)
+    idx0 = np.arange(num_win)
+    idx1 = np.minimum(idx0 + win_npts, npts)
+    num = (idx1 - idx0).astype(float)
+    # sums & cross-product sums in each win
+    mat_cum = np.zeros([num_chn, npts+1])
+    mat_cum[:,1:] = np.cumsum(mat, axis=1)
+    sum_i = mat_cum[:, idx1] - mat_cum[:, idx0]
+    cross_cum = np.zeros([num_chn, num_chn, npts+1])
+    cross_cum[:,:,1:] = np.cumsum(mat[:,None,:] * mat[None,:,:], axis=2)
+    sum_ij = cross_cum[:,:,idx1] - cross_cum[:,:,idx0]
+    # unbiased cov, as np.cov: (num_win, 3, 3)
+    cov = (sum_ij - sum_i[:,None,:] * sum_i[None,:,:] / num) / np.maximum(num-1, 1)
+    cov = np.transpose(cov, (2,0,1))
+    eig_val, eig_vec = np.linalg.eigh(cov)
+    lam1  = abs(eig_val[:,-1])
+    lam23 = abs(np.sum(eig_val, axis=1) - lam1)
+    pol_rate = 1 - (0.5 * lam23 / lam1)
+    pol_vec = eig_vec[:,:,-1]
     return pol_rate, pol_vec
 
   # calculate origin time
@@ -244,12 +389,45 @@ class STA_LTA_Kurtosis(object):
     psd = psd[:npts//2]
     return np.argmax(psd) * samp_rate / npts
 
-  # calc kurtosis trace
+  # calc kurtosis trace (sliding win; Fisher & biased, as scipy.stats.kurtosis)
+  # moments from cumsum of powers; wins with large round-off recalculated directly
+  # max abs dev from scipy: < 1e-6
   def calc_kurtosis(self, data, win_kurt_npts):
     npts = len(data) - win_kurt_npts + 1
-    kurt = np.zeros(npts)
-    for i in range(npts):
-        kurt[i] = kurtosis(data[i:i+win_kurt_npts])
+    if npts<1 or win_kurt_npts<1: return np.zeros(max(npts,0))
+    data = np.asarray(data, dtype=np.float64)
+    # shift to data min (keep low-amp wins well conditioned)
+    data_shift = np.amin(data)
+    data = data - data_shift
+    data_cum = np.zeros([4, len(data)+1])
+    abs_cum = np.zeros([4, len(data)+1])
+    for k in range(4):
+        data_cum[k,1:] = np.cumsum(data**(k+1))
+        abs_cum[k,1:] = np.cumsum(abs(data)**(k+1)) if k%2==0 else data_cum[k,1:]
+    s1, s2, s3, s4 = (data_cum[:, win_kurt_npts:] - data_cum[:, :npts]) / win_kurt_npts
+    # raw to central moments
+    m2 = s2 - s1**2
+    m4 = s4 - 4*s1*s3 + 6*s1**2*s2 - 3*s1**4
+    # estimate round-off err of cumsum diff
+    e1, e2, e3, e4 = abs_cum[:, win_kurt_npts:] * np.finfo(np.float64).eps / win_kurt_npts**0.5
+    abs_s1 = abs(s1)
+    e_m2 = e2 + 2*abs_s1*e1
+    e_m4 = e4 + 4*abs_s1*e3 + 6*abs_s1**2*e2 + 4*abs_s1**3*e1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        e_kurt = e_m4/m2**2 + 2*e_m2*abs(m4)/abs(m2)**3
+    # recalc wins with large err or flat wins
+    to_recalc = np.where(~(e_kurt < 1e-8))[0]
+    if len(to_recalc)>0:
+        win_data = np.lib.stride_tricks.sliding_window_view(data, win_kurt_npts)[to_recalc]
+        s1[to_recalc] = np.mean(win_data, axis=1)
+        win_data = win_data - s1[to_recalc, None]
+        m2[to_recalc] = np.mean(win_data**2, axis=1)
+        m4[to_recalc] = np.mean(win_data**4, axis=1)
+    # flat win --> nan, as scipy
+    is_flat = m2 <= (np.finfo(np.float64).resolution * (s1 + data_shift))**2
+    m2[is_flat] = 1.
+    kurt = m4 / m2**2 - 3.
+    kurt[is_flat] = np.nan
     return kurt
 
   def find_first_peak(self, data):
@@ -276,42 +454,255 @@ class STA_LTA_Kurtosis(object):
     return max(neg_peak[0], pos_peak[0])
 
   def preprocess(self, stream, freq_band, max_gap=5.):
-    # time alignment
+    stream = self.align_fill(stream, max_gap)
+    if len(stream)!=3: return []
+    data = self.preprocess_traces(stream, freq_band)
+    if len(data)==0: return []
+    for trace, data_i in zip(stream, data): trace.data = data_i
+    return stream
+
+  # preprocess aligned traces --> stacked (3, npts) array if same npts & samp_rate, 
+  #   else list of data (trace by trace); [] if failed
+  def preprocess_traces(self, stream, freq_band):
+    samp_rate = [trace.stats.sampling_rate for trace in stream]
+    npts = [len(trace) for trace in stream]
+    if min(npts)==max(npts) and min(samp_rate)==max(samp_rate):
+        return self.preprocess_stack(np.array([trace.data for trace in stream]), samp_rate[0], freq_band)
+    data = [self.preprocess_stack(trace.data, trace.stats.sampling_rate, freq_band) for trace in stream]
+    if any([len(data_i)==0 for data_i in data]): return []
+    return data
+
+  # time alignment, fill data gap & remove nan/inf
+  def align_fill(self, stream, max_gap=5.):
     start_time = max([trace.stats.starttime for trace in stream])
     end_time = min([trace.stats.endtime for trace in stream])
     if start_time > end_time: return []
     stream = stream.slice(start_time, end_time, nearest_sample=True)
-    # fill data gap
     max_gap_npts = int(max_gap*stream[0].stats.sampling_rate)
     for trace in stream:
-        data = trace.data
-        npts = len(data)
-        gap_idx = np.where(data==0)[0]
-        gap_list = np.split(gap_idx, np.where(np.diff(gap_idx)!=1)[0] + 1)
-        gap_list = [gap for gap in gap_list if len(gap)>=10]
-        num_gap = len(gap_list)
-        for ii,gap in enumerate(gap_list):
-            idx0, idx1 = max(0, gap[0]-1), min(npts-1, gap[-1]+1)
-            if ii<num_gap-1: idx2 = min(idx1+(idx1-idx0), idx1+max_gap_npts, gap_list[ii+1][0])
-            else: idx2 = min(idx1+(idx1-idx0), idx1+max_gap_npts, npts-1)
-            if idx1==idx2: continue
-            if idx2==idx1+(idx1-idx0): data[idx0:idx1] = data[idx1:idx2]
-            else:
-                num_tile = int(np.ceil((idx1-idx0)/(idx2-idx1)))
-                data[idx0:idx1] = np.tile(data[idx1:idx2], num_tile)[0:idx1-idx0]
-        trace.data = data
-    # filter
-    for trace in stream:
+        # masked array (e.g. merged with gaps): fill masked points
+        if np.ma.isMaskedArray(trace.data):
+            gap_mask = np.ma.getmaskarray(trace.data)
+            trace.data = self.fill_gap(trace.data.filled(0), max_gap_npts, gap_mask)
+        else: trace.data = self.fill_gap(trace.data, max_gap_npts)
         trace.data[np.isnan(trace.data)] = 0
         trace.data[np.isinf(trace.data)] = 0
-    stream.detrend('demean').detrend('linear').taper(max_percentage=0.05, max_length=5.)
+    return stream
+
+  # preprocess stacked data (..., npts): demean, detrend, taper & filter
+  # same as obspy detrend, taper(max_percentage=0.05, max_length=5.) & filter
+  # float data are demeaned in place (float32 if prep_float32)
+  def preprocess_stack(self, data, samp_rate, freq_band):
+    sos = self.design_filter(samp_rate, freq_band)
+    if sos is None: return []
+    if self.prep_float32: 
+        data = data.astype(np.float32)
+        sos = sos.astype(np.float32)
+    elif not np.issubdtype(data.dtype, np.floating): data = data.astype(np.float64)
+    # keep float32 input as float32 (as obspy detrend)
+    data -= np.mean(data, axis=-1, keepdims=True)
+    data = detrend(data, axis=-1, type='linear').astype(data.dtype, copy=False)
+    npts = data.shape[-1]
+    wlen = min(int(0.05*npts), int(5.*samp_rate), int(npts/2))
+    taper_sides = hann(2*wlen) if 2*wlen==npts else hann(2*wlen+1)
+    data[..., 0:wlen] *= taper_sides[0:wlen]
+    if wlen>0: data[..., npts-wlen:] *= taper_sides[len(taper_sides)-wlen:]
+    return sosfilt(sos, data, axis=-1)
+
+  # fill zero gaps (>=10 pts) with the following data (up to max_gap_npts, tiled)
+  # gap_mask: bool array of gap points (e.g. mask of masked array); default data==0
+  def fill_gap(self, data, max_gap_npts, gap_mask=None):
+    npts = len(data)
+    if gap_mask is None: gap_mask = (data==0)
+    # run-length encoding of gap points
+    gap_pts = np.flatnonzero(gap_mask)
+    if len(gap_pts)==0: return data
+    run_end = np.flatnonzero(np.diff(gap_pts)!=1)
+    gap_idx0 = gap_pts[np.append(0, run_end+1)]
+    gap_idx1 = gap_pts[np.append(run_end, len(gap_pts)-1)]
+    is_gap = gap_idx1 - gap_idx0 + 1 >= 10
+    gap_idx0, gap_idx1 = gap_idx0[is_gap], gap_idx1[is_gap]
+    if len(gap_idx0)==0: return data
+    # fill [idx0, idx1) with data[idx1:idx2]
+    idx0 = np.maximum(0, gap_idx0-1)
+    idx1 = np.minimum(npts-1, gap_idx1+1)
+    next_gap = np.append(gap_idx0[1:], npts-1)
+    idx2 = np.minimum(np.minimum(idx1+(idx1-idx0), idx1+max_gap_npts), next_gap)
+    to_fill = idx2>idx1
+    idx0, idx1, idx2 = idx0[to_fill], idx1[to_fill], idx2[to_fill]
+    # index maps: dst in [idx0, idx1) <-- src = idx1 + k % (idx2-idx1)
+    fill_len = idx1 - idx0
+    gap_i = np.repeat(np.arange(len(idx0)), fill_len)
+    k = np.arange(len(gap_i)) - np.repeat(np.cumsum(fill_len) - fill_len, fill_len)
+    data[idx0[gap_i] + k] = data[idx1[gap_i] + k % (idx2-idx1)[gap_i]]
+    return data
+
+  # butterworth (4 corners) SOS, same design as obspy stream.filter
+  # cached per (samp_rate, freq_band, corners); do not modify the returned array
+  def design_filter(self, samp_rate, freq_band, corners=4):
+    key = (samp_rate, tuple(freq_band), corners)
+    if key not in self.sos_cache: self.sos_cache[key] = self.calc_sos(samp_rate, freq_band, corners)
+    return self.sos_cache[key]
+
+  def calc_sos(self, samp_rate, freq_band, corners=4):
+    fe = 0.5 * samp_rate
     freq_min, freq_max = freq_band
-    if freq_min and freq_max:
-        return stream.filter('bandpass', freqmin=freq_min, freqmax=freq_max)
-    elif not freq_max and freq_min:
-        return stream.filter('highpass', freq=freq_min)
-    elif not freq_min and freq_max:
-        return stream.filter('lowpass', freq=freq_max)
+    if freq_min and freq_max and freq_max/fe - 1.0 <= -1e-6:
+        z, p, k = iirfilter(corners, [freq_min/fe, freq_max/fe], btype='band', ftype='butter', output='zpk')
+    elif freq_min:
+        z, p, k = iirfilter(corners, freq_min/fe, btype='highpass', ftype='butter', output='zpk')
+    elif freq_max:
+        z, p, k = iirfilter(corners, min(freq_max/fe, 1.), btype='lowpass', ftype='butter', output='zpk')
     else:
-        print('filter type not supported!'); return []
+        print('filter type not supported!'); return None
+    return zpk2sos(z, p, k)
+
+
+class STA_LTA_Kurtosis_Stream(object):
+  """ Streaming mode of STA_LTA_Kurtosis for one station
+    feed consecutive waveform chunks (e.g. 60s packets) --> picks
+    filter state, STA/LTA & look-back data are carried between chunks
+    pick is emitted once its S & amplitude windows are closed
+  Inputs
+    picker: STA_LTA_Kurtosis obj (picking params)
+    out_file: file obj to write picks (optional)
+    max_gap: max gap (sec) between chunks; larger gap flushes & resets the state
+  Outputs
+    picks (struct np.array) for each feed
+  Usage
+    import picker_pal
+    picker = picker_pal.STA_LTA_Kurtosis()
+    stream_picker = picker_pal.STA_LTA_Kurtosis_Stream(picker)
+    for chunk in chunks: picks = stream_picker.feed(chunk)
+    picks = stream_picker.flush()
+  *note: differs from batch pick only near the stream start (no detrend & taper)
+  """
+
+  def __init__(self, picker, out_file=None, max_gap=5.):
+    self.picker   = picker
+    self.out_file = out_file
+    self.max_gap  = max_gap
+    self.reset()
+
+  def reset(self):
+    self.buf = None        # filtered data (3, n)
+    self.buf_idx0 = 0      # abs idx of buf[:,0]
+    self.next_idx = 0      # abs idx: trig before this is done or skipped
+    self.start_time = None # time of abs idx 0
+    self.zi = None         # sosfilt state
+    self.offset = None     # DC offset (from 1st chunk)
 
+  # feed a 3-chn chunk (obspy.stream, [e, n, z])
+  def feed(self, stream):
+    if len(stream)!=3: return np.array([], dtype=pick_dtype)
+    chunk_time = max([trace.stats.starttime for trace in stream])
+    end_time = min([trace.stats.endtime for trace in stream])
+    if chunk_time > end_time: return np.array([], dtype=pick_dtype)
+    stream = stream.slice(chunk_time, end_time, nearest_sample=True)
+    head = stream[0].stats
+    chunk_time = head.starttime
+    npts = min([len(trace) for trace in stream])
+    data = np.array([trace.data[0:npts] for trace in stream], dtype=np.float64)
+    # check continuity (flush pending triggers before reset)
+    gap_picks = np.array([], dtype=pick_dtype)
+    if self.buf is not None:
+        if head.sampling_rate!=self.samp_rate:
+            gap_picks = self.pick_buf(to_flush=True)
+            self.reset()
+        else:
+            buf_end = self.buf_idx0 + self.buf.shape[1]
+            chunk_idx0 = int(round((chunk_time - self.start_time) * self.samp_rate))
+            if chunk_idx0 > buf_end + self.max_gap * self.samp_rate: 
+                print('{}: data gap, reset stream picker'.format(self.net_sta))
+                gap_picks = self.pick_buf(to_flush=True)
+                self.reset()
+            # skip overlapped pts
+            elif chunk_idx0 < buf_end: data = data[:, buf_end-chunk_idx0:]
+            # pad small gap with zeros (filled in prep)
+            elif chunk_idx0 > buf_end: 
+                data = np.concatenate([np.zeros([3, chunk_idx0-buf_end]), data], axis=1)
+    if self.buf is None: self.init_state(head, data)
+    if data.shape[1]==0: return gap_picks
+    data = self.prep_chunk(data)
+    self.buf = np.concatenate([self.buf, data], axis=1)
+    return np.concatenate([gap_picks, self.pick_buf(to_flush=False)])
+
+  # pick remaining triggers at the end of stream
+  def flush(self):
+    if self.buf is None: return np.array([], dtype=pick_dtype)
+    return self.pick_buf(to_flush=True)
+
+  def init_state(self, head, data):
+    picker = self.picker
+    self.net_sta = '.'.join([head.network, head.station])
+    self.samp_rate = head.sampling_rate
+    self.start_time = head.starttime
+    self.npts = picker.get_npts(self.samp_rate)
+    npts = self.npts
+    self.buf = np.zeros([3,0])
+    self.buf_idx0, self.next_idx = 0, 0
+    # look-back & wait (after trig) win for each trigger
+    self.look_back_npts = npts['p_win'][0] + npts['win_lta'][1] + 1 \
+        + max(npts['win_lta'][0], npts['win_lta'][2], npts['win_kurt'][0], 
+              npts['amp_win'][0], npts['pca_range'][0])
+    self.wait_npts = npts['p_win'][1] + npts['win_sta'][1] + npts['win_sta'][0] \
+        + max(npts['s_win'], npts['pca_range'][1] + npts['pca_win']) \
+        + npts['win_sta'][2] + npts['amp_win'][1]
+    # filter state
+    self.sos = picker.design_filter(self.samp_rate, picker.freq_band) if picker.to_prep else None
+    self.offset = np.mean(data, axis=1, keepdims=True) if picker.to_prep else 0.
+    if self.sos is not None:
+        zi = sosfilt_zi(self.sos)
+        self.zi = zi[:,None,:] * (data[:,0]-self.offset[:,0])[None,:,None] # (n_sec, 3, 2)
+
+  # chunk preprocess: fill gap, remove offset, causal filter with carried state
+  def prep_chunk(self, data):
+    picker = self.picker
+    data[np.isnan(data)] = 0
+    data[np.isinf(data)] = 0
+    if not picker.to_prep: return data
+    max_gap_npts = int(5. * self.samp_rate)
+    for i in range(3): data[i] = picker.fill_gap(data[i], max_gap_npts)
+    data = data - self.offset
+    if self.sos is None: return data
+    data, self.zi = sosfilt(self.sos, data, axis=1, zi=self.zi)
+    return data
+
+  # pick triggers that have enough data in buf; then trim buf
+  def pick_buf(self, to_flush=False):
+    picker, npts = self.picker, self.npts
+    buf_npts = self.buf.shape[1]
+    buf_end = self.buf_idx0 + buf_npts
+    # 1. trig picker (look-ahead sta: pts at buf end wait for next chunk)
+    cf_trig = picker.calc_sta_lta(self.buf[2]**2, npts['win_lta'][0], npts['win_sta'][0])
+    if len(cf_trig)!=buf_npts: cf_trig = np.zeros(buf_npts)
+    trig_end = buf_end if to_flush else buf_end - self.wait_npts
+    trig_index = np.where(cf_trig > picker.trig_thres)[0] + self.buf_idx0
+    trig_index = trig_index[(trig_index>=self.next_idx) * (trig_index<trig_end)]
+    # 2. phase picking
+    picks = []
+    slide_idx = 0
+    for _ in trig_index:
+        trig_idx = trig_index[slide_idx]
+        if trig_idx < npts['p_win'][0] + max(npts['win_lta']):
+            slide_idx += 1; continue
+        buf_time = self.start_time + self.buf_idx0 / self.samp_rate
+        end_time = self.start_time + (buf_end-1) / self.samp_rate
+        pick_i = picker.pick_trig(self.buf, cf_trig, trig_idx-self.buf_idx0, npts, 
+                                  buf_time, end_time, self.samp_rate)
+        if not pick_i: slide_idx = len(trig_index); break
+        tp_idx, ts_idx, tp, ts, s_amp, p_snr, fd = pick_i
+        pick = picker.output_pick(self.net_sta, tp, ts, s_amp, p_snr, fd, self.out_file)
+        if pick: picks.append(pick)
+        # next detected phase
+        self.next_idx = max(trig_idx, ts_idx+self.buf_idx0, tp_idx+self.buf_idx0) + npts['det_gap'] + 1
+        rest_det = np.where(trig_index >= self.next_idx)[0]
+        if len(rest_det)==0: break
+        slide_idx = rest_det[0]
+    self.next_idx = max(self.next_idx, trig_end)
+    # 3. trim buf: keep look-back for next trig
+    trim_idx = min(self.next_idx, trig_end) - self.look_back_npts - npts['win_lta'][0]
+    trim_npts = max(0, trim_idx - self.buf_idx0)
+    self.buf = self.buf[:, trim_npts:]
+    self.buf_idx0 += trim_npts
+    return np.array(picks, dtype=pick_dtype)
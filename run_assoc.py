@@ -1,16 +1,19 @@
-""" Run associator 
+""" Run associator
     picks --> events
 """
-import os, glob
+import os, glob, functools
 import argparse
+import multiprocessing as mp
 import numpy as np
 from obspy import UTCDateTime
 import associator_pal
+import data_pipeline
 import config
 import warnings
 warnings.filterwarnings("ignore")
 
-if __name__ == '__main__':
+
+def get_arguments_from_command_line():
     parser = argparse.ArgumentParser()
     parser.add_argument('--pick_dir', type=str,
                         default='./output/picks')
@@ -22,43 +25,97 @@ if __name__ == '__main__':
                         default='./output/catalog.tmp')
     parser.add_argument('--out_pha', type=str,
                         default='./output/phase.tmp')
+    parser.add_argument('--num_workers', type=int,
+                        default=1)
+    parser.add_argument('--shard_len', type=float,
+                        default=24., help='time shard length (hours)')
+    parser.add_argument('--halo', type=float,
+                        default=None, help='shard overlap (sec); default 5*ot_dev')
     args = parser.parse_args()
+    return args
+
+
+# shard worker state: set by init_shard_worker (as init args, not inherited by fork)
+associator, picks, halo = [None]*3
+
+
+def init_shard_worker(*shard_state):
+    global associator, picks, halo
+    associator, picks, halo = shard_state
+
+
+def run_shard(shard):
+    return associator.associate_shard(picks, shard[0], shard[1], halo)
 
 
-# define func
-cfg = config.Config()
-get_picks = cfg.get_picks
-sta_dict = cfg.get_sta_dict(args.sta_file)
-associator = associator_pal.TS_Assoc(\
-    sta_dict,
-    xy_margin = cfg.xy_margin,
-    xy_grid = cfg.xy_grid,
-    z_grids = cfg.z_grids,
-    min_sta = cfg.min_sta,
-    ot_dev = cfg.ot_dev,
-    max_res = cfg.max_res,
-    vp = cfg.vp)
-# i/o paths
-out_root = os.path.split(args.out_ctlg)[0]
-if not os.path.exists(out_root): os.makedirs(out_root)
-out_ctlg = open(args.out_ctlg,'w')
-out_pha = open(args.out_pha,'w')
-
-# get date range
-start_date, end_date = [UTCDateTime(date) for date in args.time_range.split('-')]
-print('run assoc: picks --> events')
-print('time range: {} to {}'.format(start_date.date, end_date.date))
-
-# for all days
-num_day = (end_date.date - start_date.date).days
-for day_idx in range(num_day):
-    # 1. get picks
-    date = start_date + day_idx*86400
-    picks = get_picks(date, args.pick_dir)
-    picks = picks[[net_sta in sta_dict for net_sta in picks['net_sta']]]
-    # 2. associate picks: picks --> event_picks & event_loc
-    associator.associate(picks, out_ctlg, out_pha)
-
-# finish making catalog
-out_pha.close()
-out_ctlg.close()
+def main():
+    args = get_arguments_from_command_line()
+
+    # define func
+    cfg = config.Config()
+    get_picks = cfg.get_picks
+    sta_dict = cfg.get_sta_dict(args.sta_file)
+    # tiled associator for large networks
+    if cfg.tile_size: TS_Assoc = functools.partial(associator_pal.TS_Assoc_Tiled,
+        tile_size=cfg.tile_size, tile_overlap=cfg.tile_overlap)
+    else: TS_Assoc = associator_pal.TS_Assoc
+    associator = TS_Assoc(\
+        sta_dict,
+        xy_margin = cfg.xy_margin,
+        xy_grid = cfg.xy_grid,
+        z_grids = cfg.z_grids,
+        min_sta = cfg.min_sta,
+        ot_dev = cfg.ot_dev,
+        max_res = cfg.max_res,
+        vp = cfg.vp,
+        tt_cache_dir = cfg.tt_cache_dir,
+        coarse_factor = cfg.coarse_factor,
+        vel_mod = cfg.vel_mod,
+        ref_ele = cfg.ref_ele)
+    # i/o paths
+    out_root = os.path.split(args.out_ctlg)[0]
+    if not os.path.exists(out_root): os.makedirs(out_root)
+    out_ctlg = open(args.out_ctlg,'w')
+    out_pha = open(args.out_pha,'w')
+
+    # get date range
+    start_date, end_date = [UTCDateTime(date) for date in args.time_range.split('-')]
+    print('run assoc: picks --> events')
+    print('time range: {} to {}'.format(start_date.date, end_date.date))
+
+    num_day = (end_date.date - start_date.date).days
+    dates = [start_date + day_idx*86400 for day_idx in range(num_day)]
+
+    # time shards with overlap (halo) --> events sorted by ot
+    #   shards are associated in a pool (num_workers>1) or one by one, with the same output
+    picks = [get_picks(date, args.pick_dir, associator.sta_list) for date in dates]
+    picks = np.concatenate(picks) if picks else np.array([], dtype=data_pipeline.pick_dtype)
+    halo = args.halo if args.halo is not None else 5*cfg.ot_dev
+    t0, t1, shard_len = start_date.timestamp, (start_date + num_day*86400).timestamp, args.shard_len*3600
+    shards = [(t, min(t+shard_len, t1)) for t in np.arange(t0, t1, shard_len)]
+    # outer shards own all events of the range's pick files, incl. ot before t0 (long tt) or after t1
+    if shards:
+        shards[0] = (-np.inf, shards[0][1])
+        shards[-1] = (shards[-1][0], np.inf)
+    shard_state = (associator, picks, halo)
+    if args.num_workers>1:
+        pool = mp.Pool(args.num_workers, initializer=init_shard_worker, initargs=shard_state)
+        results = pool.map(run_shard, shards, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        init_shard_worker(*shard_state)
+        results = [run_shard(shard) for shard in shards]
+    events = [event for shard_events, shard_picks in results for event in zip(shard_events, shard_picks)]
+    events.sort(key=lambda event: event[0]['evt_ot'])
+    for event_loc, event_pick in events:
+        associator.write_catalog(event_loc, out_ctlg)
+        associator.write_phase(event_loc, event_pick, out_pha)
+
+    # finish making catalog
+    out_pha.close()
+    out_ctlg.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,342 @@
 """ Run picker and associator
     raw waveforms --> picks --> events
 """
-import os, glob
+import os, glob, shutil, functools, io, queue, hashlib
 import argparse
+import multiprocessing as mp
 import numpy as np
 from obspy import UTCDateTime
 import picker_pal
 import associator_pal
+import data_pipeline
 import config
 import warnings
 warnings.filterwarnings("ignore")
 
-if __name__ == '__main__':
-    def get_arguments_from_command_line():
-
-        parser = argparse.ArgumentParser()
-        parser.add_argument('--data_dir', type=str,
-                        default='/data2/ZSY_SAC')
-        parser.add_argument('--time_range', type=str,
-                        default='20171003-20171004')
-        parser.add_argument('--sta_file', type=str,
-                        default='input/station.dat')
-        parser.add_argument('--out_ctlg', type=str,
-                        default='./output/tmp.ctlg')
-        parser.add_argument('--out_pha', type=str,
-                        default='./output/tmp.pha')
-        parser.add_argument('--out_pick_dir', type=str,
-                        default='./output/picks')
-        args = parser.parse_args()
-        return args
-    
 
+def get_arguments_from_command_line():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str,
+                    default='/data2/ZSY_SAC')
+    parser.add_argument('--time_range', type=str,
+                    default='20171003-20171004')
+    parser.add_argument('--sta_file', type=str,
+                    default='input/station.dat')
+    parser.add_argument('--out_ctlg', type=str,
+                    default='./output/tmp.ctlg')
+    parser.add_argument('--out_pha', type=str,
+                    default='./output/tmp.pha')
+    parser.add_argument('--out_pick_dir', type=str,
+                    default='./output/picks')
+    parser.add_argument('--batch_size', type=int,
+                    default=1)
+    parser.add_argument('--num_workers', type=int,
+                    default=1)
+    parser.add_argument('--pick_format', type=str,
+                    default='txt', choices=['txt','bin'])
+    parser.add_argument('--data_index', type=str,
+                    default=None)
+    parser.add_argument('--num_prefetch', type=int,
+                    default=2)
+    parser.add_argument('--pipeline', action='store_true',
+                    help='associate in a separate process, overlapped with picking')
+    parser.add_argument('--resume', action='store_true',
+                    help='skip finished station-days & days (manifest in out_pick_dir)')
+    args = parser.parse_args()
+    return args
+
+
+def get_date_of_day_x(start_date, x_days_after_start_date):
+    day_in_sec = 86400
+    date = start_date + x_days_after_start_date * day_in_sec
+
+    return date
+
+
+def get_net_sta(paths):
+    return '.'.join(os.path.basename(paths[0]).split('.')[0:2])
+
+
+def split_into_pick_tasks(data_paths, batch_size):
+    return [data_paths[i:i+batch_size] for i in range(0, len(data_paths), batch_size)]
+
+
+""" picking & association state of each process: the single source of truth, in main & pool workers
+    made by get_pick_state & get_assoc_state, set by init_picker (main & pool workers) and init_assoc
+    (main, and assoc process in pipeline mode), so that workers get it as init args instead of relying
+    on globals inherited by fork; output files are opened by open_assoc where association runs
+"""
+picker, sta_dict, read_data, prep_cache, prep_params = [None]*5
+associator, manifest, assoc_params, out_paths, out_ctlg, out_pha = [None]*6
+
+
+def get_pick_state(cfg, sta_file):
+    sta_dict = cfg.get_sta_dict(sta_file)
+    picker = picker_pal.STA_LTA_Kurtosis(\
+        win_sta = cfg.win_sta,
+        win_lta = cfg.win_lta,
+        trig_thres = cfg.trig_thres,
+        p_win = cfg.p_win,
+        s_win = cfg.s_win,
+        pca_win = cfg.pca_win,
+        pca_range = cfg.pca_range,
+        fd_thres = cfg.fd_thres,
+        amp_win = cfg.amp_win,
+        win_kurt = cfg.win_kurt,
+        det_gap = cfg.det_gap,
+        to_prep = cfg.to_prep,
+        freq_band = cfg.freq_band,
+        prep_float32 = cfg.prep_float32,
+        sta_list = list(sta_dict.keys()))
+    # cache of preprocessed data (re-pick with other detection params)
+    if cfg.prep_cache_dir: prep_cache = data_pipeline.PrepCache(cfg.prep_cache_dir, cfg.prep_cache_size)
+    else: prep_cache = None
+    prep_params = [cfg.to_prep, cfg.freq_band, cfg.prep_float32]
+    return picker, sta_dict, cfg.read_data, prep_cache, prep_params
+
+
+def get_assoc_state(cfg, sta_dict, arguments):
+    # tiled associator for large networks
+    if cfg.tile_size: TS_Assoc = functools.partial(associator_pal.TS_Assoc_Tiled,
+        tile_size=cfg.tile_size, tile_overlap=cfg.tile_overlap)
+    else: TS_Assoc = associator_pal.TS_Assoc
+    associator = TS_Assoc(\
+        sta_dict,
+        xy_margin = cfg.xy_margin,
+        xy_grid = cfg.xy_grid,
+        z_grids = cfg.z_grids,
+        min_sta = cfg.min_sta,
+        ot_dev = cfg.ot_dev,
+        max_res = cfg.max_res,
+        vp = cfg.vp,
+        tt_cache_dir = cfg.tt_cache_dir,
+        coarse_factor = cfg.coarse_factor,
+        vel_mod = cfg.vel_mod,
+        ref_ele = cfg.ref_ele)
+    # resumable runs: manifest of finished station-days & days
+    if arguments.resume:
+        manifest = data_pipeline.RunManifest(os.path.join(arguments.out_pick_dir, 'manifest'))
+        assoc_params = [cfg.min_sta, cfg.ot_dev, cfg.max_res, cfg.xy_margin, cfg.xy_grid, cfg.z_grids, cfg.vp,
+            cfg.coarse_factor, cfg.vel_mod, cfg.ref_ele, cfg.tile_size, cfg.tile_overlap,
+            [[net_sta] + sta_dict[net_sta][0:3] for net_sta in associator.sta_list]]
+    else: manifest, assoc_params = None, None
+    return associator, manifest, assoc_params, (arguments.out_ctlg, arguments.out_pha)
+
+
+def init_picker(*pick_state):
+    global picker, sta_dict, read_data, prep_cache, prep_params
+    picker, sta_dict, read_data, prep_cache, prep_params = pick_state
+
+
+def init_assoc(*assoc_state):
+    global associator, manifest, assoc_params, out_paths
+    associator, manifest, assoc_params, out_paths = assoc_state
+
+
+def open_assoc():
+    global out_ctlg, out_pha
+    out_ctlg = open(out_paths[0],'w')
+    out_pha = open(out_paths[1],'w')
+
+
+def close_assoc():
+    out_pha.close()
+    out_ctlg.close()
+
+
+def read_task(task):
+    if prep_cache: return [read_prep(paths) for paths in task]
+    return [read_data(paths, sta_dict) for paths in task]
+
+
+def get_read_params(paths):
+    # what read_data output depends on, besides the data files: read func & sta gain
+    read_func = '{}.{}'.format(read_data.__module__, read_data.__name__)
+    return [read_func, data_pipeline.get_gain_key(sta_dict[get_net_sta(paths)][3])]
+
+
+def read_prep(paths):
+    # preprocessed data from cache, or read & preprocess
+    key = prep_cache.get_key(paths, [get_read_params(paths), prep_params])
+    prep = prep_cache.get(key)
+    if prep is None:
+        prep = picker.prep_data(read_data(paths, sta_dict))
+        if prep is not None: prep_cache.put(key, *prep)
+    return prep
+
+
+def pick_streams(streams):
+    # pick one by one, or pick a batch of stations on stacked arrays
+    print('-'*40)
+    if prep_cache:
+        preps = [prep for prep in streams if prep is not None]
+        if len(preps)==1: return picker.pick_data(*preps[0])
+        return picker.pick_many_data(preps, batch_size=len(preps))
+    if len(streams)==1: return picker.pick(streams[0])
+    return picker.pick_many(streams, batch_size=len(streams))
+
+
+def run_pick_task(task):
+    return pick_streams(read_task(task))
+
+
+def associate_day(date, picks):
+    if not manifest:
+        associator.associate(picks, out_ctlg, out_pha); return
+    # re-associate only if picks or assoc params changed
+    assoc_key = data_pipeline.hash_key([hashlib.sha1(picks.tobytes()).hexdigest(), assoc_params])
+    assoc = manifest.load_assoc(date)
+    if assoc and assoc[0]==assoc_key:
+        print('{}: picks not changed, use finished catalog'.format(date.date))
+        ctlg, pha = assoc[1:]
+    else:
+        out_ctlg_day, out_pha_day = io.StringIO(), io.StringIO()
+        associator.associate(picks, out_ctlg_day, out_pha_day)
+        ctlg, pha = out_ctlg_day.getvalue(), out_pha_day.getvalue()
+    out_ctlg.write(ctlg)
+    out_pha.write(pha)
+    manifest.save_assoc(date, assoc_key, ctlg, pha)
+
+
+def run_assoc_stage(assoc_queue, assoc_state):
+    # associate days in input order --> deterministic catalog & phase file
+    init_assoc(*assoc_state)
+    open_assoc()
+    while True:
+        item = assoc_queue.get()
+        if item is None: break
+        associate_day(*item)
+    close_assoc()
+
+
+def main():
     arguments = get_arguments_from_command_line()
 
+    # PAL config --> state of main (& workers)
+    cfg = config.Config()
+    get_data_dict = cfg.get_data_dict
+    pick_state = get_pick_state(cfg, arguments.sta_file)
+    init_picker(*pick_state)
+    assoc_state = get_assoc_state(cfg, sta_dict, arguments)
+    init_assoc(*assoc_state)
+    # picker params for task keys of the manifest
+    picker_params = [cfg.win_sta, cfg.win_lta, cfg.trig_thres, cfg.p_win, cfg.s_win, cfg.pca_win, cfg.pca_range,
+        cfg.win_kurt, cfg.fd_thres, cfg.amp_win, cfg.det_gap, cfg.to_prep, cfg.freq_band, cfg.prep_float32]
+    out_root = os.path.split(arguments.out_ctlg)[0]
+    if not os.path.exists(out_root): os.makedirs(out_root)
+    if not os.path.exists(arguments.out_pick_dir): os.makedirs(arguments.out_pick_dir)
 
-# PAL config
-cfg = config.Config()
-get_data_dict = cfg.get_data_dict
-read_data = cfg.read_data
-sta_dict = cfg.get_sta_dict(arguments.sta_file)
-picker = picker_pal.STA_LTA_Kurtosis(\
-    win_sta = cfg.win_sta,
-    win_lta = cfg.win_lta,
-    trig_thres = cfg.trig_thres,
-    p_win = cfg.p_win,
-    s_win = cfg.s_win,
-    pca_win = cfg.pca_win, 
-    pca_range = cfg.pca_range,
-    fd_thres = cfg.fd_thres,
-    amp_win = cfg.amp_win,
-    win_kurt = cfg.win_kurt,
-    det_gap = cfg.det_gap,
-    to_prep = cfg.to_prep,
-    freq_band = cfg.freq_band)
-associator = associator_pal.TS_Assoc(\
-    sta_dict,
-    xy_margin = cfg.xy_margin,
-    xy_grid = cfg.xy_grid, 
-    z_grids = cfg.z_grids,
-    min_sta = cfg.min_sta,
-    ot_dev = cfg.ot_dev,
-    max_res = cfg.max_res,
-    vp = cfg.vp)
-out_root = os.path.split(arguments.out_ctlg)[0]
-if not os.path.exists(out_root): os.makedirs(out_root)
-if not os.path.exists(arguments.out_pick_dir): os.makedirs(arguments.out_pick_dir)
-out_ctlg = open(arguments.out_ctlg,'w')
-out_pha = open(arguments.out_pha,'w')
-
-
-def get_time_range():
-    return [UTCDateTime(date) for date in arguments.time_range.split('-')]
-
-
-start_date, end_date = get_time_range()
-
-
-def print_time_range():
+    start_date, end_date = [UTCDateTime(date) for date in arguments.time_range.split('-')]
     print('run pick & assoc: raw_waveform --> picks --> events')
     print('time range: {} to {}'.format(start_date.date, end_date.date))
+    # index of data files (built once, updated with new days)
+    if arguments.data_index: data_pipeline.update_data_index(arguments.data_dir, arguments.data_index)
 
 
-print_time_range()
+    def get_data_paths(date):
+        if arguments.data_index: data_dict = get_data_dict(date, arguments.data_dir, arguments.data_index)
+        else: data_dict = get_data_dict(date, arguments.data_dir)
+        to_delete = [net_sta for net_sta in data_dict if net_sta not in sta_dict]
+        for net_sta in to_delete: data_dict.pop(net_sta)
 
-def get_date_of_day_x(start_date, x_days_after_start_date):
-    day_in_sec = 86400
-    date = start_date + x_days_after_start_date * day_in_sec
+        return list(data_dict.values())
 
-    return date
 
-# for all days
-num_days = (end_date.date - start_date.date).days
-for day_x in range(num_days):
-    # get data paths
-    date = get_date_of_day_x(start_date, day_x)
-    
-    data_dict = get_data_dict(date, arguments.data_dir)
-    to_delete = [net_sta for net_sta in data_dict if net_sta not in sta_dict]
-    for net_sta in to_delete: data_dict.pop(net_sta)
-    if data_dict=={}: continue
-    # 1. phase picking: waveform --> picks
-    fpick_path = os.path.join(arguments.out_pick_dir, str(date.date)+'.pick')
-    out_pick = open(fpick_path,'w')
-    for i, data_filename_list in enumerate(data_dict.values()):
-        print('-'*40)
-        stream = read_data(data_filename_list, sta_dict)
-        picks_i = picker.pick(stream, out_pick)
-        picks = picks_i if i==0 else np.append(picks, picks_i)
-    out_pick.close()
-    # 2. associate picks: picks --> event_picks & event_loc
-    associator.associate(picks, out_ctlg, out_pha)
-
-
-
-
-# finish making catalog
-out_pha.close()
-out_ctlg.close()
+    def plan_day(date):
+        # data paths & task keys of the day; station-days to pick (new or changed)
+        #   task key: data files, what read_data depends on (sta gain) & picker params
+        data_paths = get_data_paths(date)
+        if not manifest: return data_paths, data_paths, None
+        task_keys = {get_net_sta(paths): data_pipeline.hash_key(
+            [data_pipeline.file_identity(paths), get_read_params(paths), picker_params]) for paths in data_paths}
+        done_keys = manifest.load_task_keys(date)
+        todo_paths = [paths for paths in data_paths if done_keys.get(get_net_sta(paths))!=task_keys[get_net_sta(paths)]]
+        print('{}: {} of {} station-days to pick'.format(date.date, len(todo_paths), len(data_paths)))
+        return data_paths, todo_paths, task_keys
+
+
+    def save_task_picks(date, task, task_keys, picks):
+        # finished station-days of a pick task --> manifest
+        for paths in task:
+            net_sta = get_net_sta(paths)
+            manifest.save_picks(date, net_sta, task_keys[net_sta], picks[picks['sta']==picker.get_sta_idx(net_sta)])
+
+
+    def merge_picks(date, data_paths, todo_paths, picks):
+        # new picks & finished picks of the day (from manifest), in data_paths order
+        todo_sta = set([get_net_sta(paths) for paths in todo_paths])
+        picks_list = []
+        for paths in data_paths:
+            net_sta = get_net_sta(paths)
+            if net_sta in todo_sta: picks_list.append(picks[picks['sta']==picker.get_sta_idx(net_sta)])
+            else: picks_list.append(manifest.load_picks(date, net_sta, picker.sta_list))
+        return np.concatenate(picks_list)
+
+
+    def put_assoc(item):
+        # bounded queue: wait for assoc stage, unless it died
+        while True:
+            try: assoc_queue.put(item, timeout=1.); return
+            except queue.Full:
+                if not assoc_proc.is_alive(): raise RuntimeError('association process exited')
+
+
+    # pipeline mode: pick (main/pool) --> associate (one process), day N assoc while picking day N+1
+    if arguments.pipeline:
+        assoc_queue = mp.Queue(maxsize=2)
+        assoc_proc = mp.Process(target=run_assoc_stage, args=(assoc_queue, assoc_state), daemon=True)
+        assoc_proc.start()
+    else: open_assoc()
+
+    # get (day, station) tasks for all days
+    num_days = (end_date.date - start_date.date).days
+    dates = [get_date_of_day_x(start_date, day_x) for day_x in range(num_days)]
+    day_plans = [plan_day(date) for date in dates]
+    day_tasks = [split_into_pick_tasks(plan[1], arguments.batch_size) for plan in day_plans]
+    all_tasks = [task for tasks in day_tasks for task in tasks]
+    # station-parallel picking: results come back in task order
+    if arguments.num_workers>1:
+        pool = mp.Pool(arguments.num_workers, initializer=init_picker, initargs=pick_state)
+        pick_results = pool.imap(run_pick_task, all_tasks, chunksize=1)
+    else:
+        # read next tasks in background while picking the current one
+        streams_iter = data_pipeline.prefetch_data(read_task, all_tasks, arguments.num_prefetch)
+        pick_results = map(pick_streams, streams_iter)
+
+    # for all days
+    for date, (data_paths, todo_paths, task_keys), tasks in zip(dates, day_plans, day_tasks):
+        if len(data_paths)==0: continue
+        # 1. phase picking: waveform --> picks
+        picks = np.array([], dtype=data_pipeline.pick_dtype)
+        for task in tasks:
+            task_picks = next(pick_results)
+            if manifest: save_task_picks(date, task, task_keys, task_picks)
+            picks = np.append(picks, task_picks)
+        if manifest: picks = merge_picks(date, data_paths, todo_paths, picks)
+        fpick_path = os.path.join(arguments.out_pick_dir, str(date.date)+'.pick')
+        if arguments.pick_format=='txt': out_pick = open(fpick_path,'w')
+        else: out_pick = data_pipeline.BinPickWriter(fpick_path+'s', picker.sta_list)
+        # remove picks of the other format (from older runs)
+        old_path = fpick_path+'s' if arguments.pick_format=='txt' else fpick_path
+        if os.path.isdir(old_path): shutil.rmtree(old_path)
+        elif os.path.exists(old_path): os.remove(old_path)
+        for pick in picks: picker.write_pick(pick, out_pick)
+        out_pick.close()
+        # 2. associate picks: picks --> event_picks & event_loc
+        if arguments.pipeline: put_assoc((date, picks))
+        else: associate_day(date, picks)
+
+    if arguments.num_workers>1:
+        pool.close()
+        pool.join()
+    if arguments.pipeline:
+        put_assoc(None)
+        assoc_proc.join()
+        if assoc_proc.exitcode!=0: raise RuntimeError('association process exited')
+    # finish making catalog
+    else: close_assoc()
+
+
+if __name__ == '__main__':
+    main()